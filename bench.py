@@ -0,0 +1,178 @@
+"""
+Throughput benchmarks that run on the cpu, on small synthetic data and configs:
+- model: GPT forward+backward tokens/s and activation memory for a few GPTConfig sizes, with and
+  without activation checkpointing
+- loader: batches/s of the train data loader, for the single-file and the multi-file layout
+- data: text cleaning and bpe encoding MB/s of the data scripts (needs unidecode and tokenizers)
+- generate: GPT.generate tokens/s, with and without the kv cache
+
+Results are written as JSON, compare two of them (e.g. from two commits) with compare=:
+$ python bench.py --out_file=before.json
+$ python bench.py --out_file=after.json --compare=before.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import subprocess
+
+import numpy as np
+import torch
+
+from model import GPTConfig, GPT
+from dataloader import ShardedDataset, EpochSampler
+
+# -----------------------------------------------------------------------------
+suites = 'model,loader,data,generate' # comma separated subset of the benchmarks above
+out_file = 'bench.json'
+compare = '' # a previous out_file to print ratios against
+device = 'cpu'
+min_time = 2.0 # seconds each measurement runs for, at least
+threads = 0 # torch intra-op threads, 0 for the torch default
+seed = 1337
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+torch.manual_seed(seed)
+if threads > 0:
+    torch.set_num_threads(threads)
+
+MODEL_CONFIGS = {
+    'tiny': (dict(n_layer=2, n_head=2, n_embd=64, block_size=128, vocab_size=512), 16),
+    'small': (dict(n_layer=4, n_head=4, n_embd=128, block_size=256, vocab_size=2048), 8),
+    'medium': (dict(n_layer=6, n_head=6, n_embd=384, block_size=256, vocab_size=8192), 4),
+}
+
+def timeit(fn):
+    """ Calls per second of fn, after one warmup call. """
+    fn()
+    n, t0 = 0, time.perf_counter()
+    while time.perf_counter() - t0 < min_time:
+        fn()
+        n += 1
+    return n / (time.perf_counter() - t0)
+
+def saved_activation_bytes(model, fn):
+    """ Bytes of the activations autograd keeps for backward while running fn, counting shared storage once. """
+    params = set(p.untyped_storage().data_ptr() for p in model.parameters())
+    storages = {}
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in params:
+            storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        out = fn()
+    return out, sum(storages.values())
+
+def bench_model(results):
+    for name, (cfg, batch_size) in MODEL_CONFIGS.items():
+        for activation_checkpointing in ('none', 'all'):
+            torch.manual_seed(seed)
+            model = GPT(GPTConfig(**cfg, dropout=0.0, activation_checkpointing=activation_checkpointing)).to(device)
+            x = torch.randint(cfg['vocab_size'], (batch_size, cfg['block_size']), device=device)
+            def step():
+                logits, loss = model(x, x)
+                loss.backward()
+                model.zero_grad(set_to_none=True)
+            key = f"model/{name}/{'ckpt' if activation_checkpointing == 'all' else 'nockpt'}"
+            if 'cuda' in device:
+                torch.cuda.reset_peak_memory_stats()
+            results[f"{key}/fwdbwd_tok_s"] = timeit(step) * x.numel()
+            # activations kept alive between forward and backward, what checkpointing trades for compute
+            (logits, loss), saved = saved_activation_bytes(model, lambda: model(x, x))
+            results[f"{key}/saved_activations_mb"] = saved / 2**20
+            if 'cuda' in device:
+                results[f"{key}/peak_allocated_mb"] = torch.cuda.max_memory_allocated() / 2**20
+
+def bench_loader(results):
+    block_size, batch_size = 256, 32
+    with tempfile.TemporaryDirectory() as tmp:
+        rng = np.random.default_rng(seed)
+        # 16M tokens, once as a single file and once as 16 shards
+        tokens = rng.integers(0, 2**16, size=16 * 2**20, dtype=np.uint16)
+        tokens.tofile(os.path.join(tmp, 'train.bin'))
+        os.makedirs(os.path.join(tmp, 'train'))
+        shards = []
+        for i, chunk in enumerate(np.split(tokens, 16)):
+            chunk.tofile(os.path.join(tmp, 'train', f"{i:06d}.bin"))
+            shards.append({'name': f"{i:06d}.bin", 'num_tokens': len(chunk), 'offset': i * len(chunk)})
+        layouts = {
+            'single': ShardedDataset.from_single_file(os.path.join(tmp, 'train.bin'), block_size),
+            'sharded': ShardedDataset(os.path.join(tmp, 'train'), shards, block_size),
+        }
+        out = torch.empty((batch_size, block_size + 1), dtype=torch.int64)
+        for name, dataset in layouts.items():
+            results[f"loader/{name}/random_batch_s"] = timeit(lambda: dataset.sample(batch_size, out=out))
+            sampler = EpochSampler(dataset.num_chunks, batch_size, seed)
+            steps = iter(range(10**9))
+            results[f"loader/{name}/epoch_batch_s"] = timeit(lambda: dataset.read(sampler.indices(next(steps)), out=out))
+
+def bench_data(results):
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'))
+    try:
+        import encoder
+        from wikiclean import clean_text
+    except ImportError as e:
+        print(f"skipping the data benchmarks: {e}")
+        return
+    # wikipedia-like text with accents, non-latin scripts and the punctuation the cleaning removes
+    rng = random.Random(seed)
+    words = ['the', 'city', 'river', 'was', 'founded', 'in', 'and', 'population', 'km', 'of', 'Zurich',
+             'café', 'Málaga', 'Łódź', 'naïve', 'Straße', 'Ελλάδα', 'Москва', '東京', '(', ')', '()', ' , ', '\n']
+    articles = [' '.join(rng.choice(words) for _ in range(rng.randint(50, 2000))) for _ in range(500)]
+    num_bytes = sum(len(text.encode('utf-8')) for text in articles)
+    results["data/clean_mb_s"] = timeit(lambda: [clean_text(text) for text in articles]) * num_bytes / 1e6
+
+    text = ''.join(clean_text(text) for text in articles)
+    tokenizer, trainer = encoder.new_tokenizer(2000)
+    tokenizer.train_from_iterator([text], trainer=trainer)
+    encoder.tokenizer = tokenizer
+    results["data/encode_mb_s"] = timeit(lambda: encoder.encode_text(text)) * len(text.encode('utf-8')) / 1e6
+
+def bench_generate(results):
+    prompt_len, max_new_tokens = 16, 128
+    for name in ('tiny', 'small'):
+        cfg, _ = MODEL_CONFIGS[name]
+        model = GPT(GPTConfig(**cfg, dropout=0.0)).to(device).eval()
+        for batch_size in (1, 4):
+            x = torch.randint(cfg['vocab_size'], (batch_size, prompt_len), device=device)
+            for use_cache in (True, False):
+                with torch.no_grad():
+                    calls = timeit(lambda: model.generate(x, max_new_tokens, top_k=200, use_cache=use_cache))
+                results[f"generate/{name}/b{batch_size}/{'cache' if use_cache else 'nocache'}_tok_s"] = calls * batch_size * max_new_tokens
+
+if __name__ == "__main__":
+    results = {}
+    for suite in suites.split(','):
+        t0 = time.time()
+        {'model': bench_model, 'loader': bench_loader, 'data': bench_data, 'generate': bench_generate}[suite](results)
+        print(f"{suite} benchmarks took {time.time()-t0:.1f}s")
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    report = {
+        'commit': commit,
+        'torch': torch.__version__,
+        'device': device,
+        'threads': torch.get_num_threads(),
+        'time': time.time(),
+        'results': results,
+    }
+    with open(out_file, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    previous = {}
+    if compare:
+        with open(compare) as f:
+            previous = json.load(f)['results']
+        print(f"{'benchmark':<40} {'before':>12} {'after':>12} {'ratio':>7}")
+    for name, value in results.items():
+        if name in previous:
+            print(f"{name:<40} {previous[name]:>12.1f} {value:>12.1f} {value/previous[name]:>6.2f}x")
+        else:
+            print(f"{name:<40} {value:>12.1f}")
+    print(f"results written to {out_file}")
@@ -0,0 +1,76 @@
+"""
+Tokens/s and val perplexity of the low-precision cpu inference modes of quantize.py, against the
+float32 model. Perplexity is measured on num_windows windows of block_size tokens spread evenly
+over the val split, generation speed with a KV cache at batch size 1 (latency bound, like
+prompt.py with batch_samples=False) and at batch_size (throughput bound).
+$ python bench_quantize.py --out_dir=bpe-simplewiki-out --dataset=data/prepare-out --threads=4
+"""
+import os
+import math
+import time
+import pickle
+
+import torch
+
+from checkpoint import load_model
+from dataloader import ShardedDataset, load_manifest, split_xy
+from quantize import quantize_model
+
+# -----------------------------------------------------------------------------
+out_dir = 'bpe-simplewiki-out' # holds the model.pt written by export.py
+dataset = 'data/prepare-out'
+multi_file_dataset = True # val/ shards with a manifest, else a single val.bin
+modes = 'none int8 int8_weight bf16' # quantize.py modes to compare, space separated, 'none' is the float32 baseline
+num_windows = 32 # val windows the perplexity is computed on
+batch_size = 8
+max_new_tokens = 64 # generated per measurement of tokens/s
+threads = 0 # torch intra-op threads, 0 for the torch default
+seed = 1337
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+@torch.no_grad()
+def perplexity(model, tokens):
+    nll = 0.0
+    for batch in tokens.split(batch_size):
+        _, loss = model(*split_xy(batch))
+        nll += loss.item() * batch.size(0)
+    return math.exp(nll / tokens.size(0))
+
+def generate_tokens_per_s(model, prompt):
+    # stay within block_size, past it every step is a full-window forward instead of a decode step
+    new_tokens = min(max_new_tokens, model.config.block_size - prompt.size(1))
+    torch.manual_seed(seed)
+    model.generate(prompt, 4) # warmup
+    t0 = time.perf_counter()
+    model.generate(prompt, new_tokens)
+    return prompt.size(0) * new_tokens / (time.perf_counter() - t0)
+
+if __name__ == "__main__":
+    if threads > 0:
+        torch.set_num_threads(threads)
+    token_dtype = 'uint16'
+    meta_path = os.path.join(dataset, 'meta.pkl')
+    if os.path.exists(meta_path):
+        with open(meta_path, 'rb') as f:
+            token_dtype = pickle.load(f).get('dtype', token_dtype)
+
+    results = {}
+    for mode in modes.split():
+        model, _ = load_model(os.path.join(out_dir, 'model.pt'))
+        block_size = model.config.block_size
+        if not results:
+            if multi_file_dataset:
+                val = ShardedDataset(os.path.join(dataset, 'val'), load_manifest(dataset, token_dtype)['val'], block_size, token_dtype)
+            else:
+                val = ShardedDataset.from_single_file(os.path.join(dataset, 'val.bin'), block_size, token_dtype)
+            tokens = val.read(val.spread(num_windows))
+            prompt = tokens[:batch_size, :16]
+        model = quantize_model(model, mode)
+        results[mode] = (perplexity(model, tokens), generate_tokens_per_s(model, prompt[:1]), generate_tokens_per_s(model, prompt))
+
+    print(f"{torch.get_num_threads()} threads, perplexity on {num_windows} val windows of {block_size} tokens")
+    print(f"{'mode':<12} {'val ppl':>9} {'drift':>8} {'tok/s b1':>9} {'speedup':>8} {f'tok/s b{batch_size}':>9} {'speedup':>8}")
+    ppl0, b1_0, bn_0 = results.get('none', next(iter(results.values())))
+    for mode, (ppl, b1, bn) in results.items():
+        print(f"{mode:<12} {ppl:>9.3f} {(ppl / ppl0 - 1) * 100:>7.2f}% {b1:>9.1f} {b1 / b1_0:>7.2f}x {bn:>9.1f} {bn / bn_0:>7.2f}x")
@@ -0,0 +1,76 @@
+"""
+Perplexity versus throughput of decoding past block_size (GPT.next_logits) for several
+window_stride values, on held-out val shards. Sequences of seq_len val tokens are walked token by
+token with teacher forcing: every step runs exactly the forwards generate would run at that
+length, and the true next token is scored, so tokens/s is the decode speed and the perplexity
+that of the context each stride leaves the model. Only positions from block_size on are scored,
+before that all strides are identical. window_stride=0 is the exact full-window recompute, drift
+and speedup are relative to the first stride in the list.
+$ python bench_window.py --out_dir=bpe-simplewiki-out --dataset=data/prepare-out --device=cpu
+"""
+import os
+import math
+import time
+import pickle
+
+import torch
+from torch.nn import functional as F
+
+from checkpoint import load_model
+from dataloader import ShardedDataset, load_manifest
+
+# -----------------------------------------------------------------------------
+out_dir = 'bpe-simplewiki-out' # holds the model.pt written by export.py
+dataset = 'data/prepare-out'
+multi_file_dataset = True # val/ shards with a manifest, else a single val.bin
+strides = '0 8 32 128' # window_stride values to compare, space separated
+num_sequences = 4 # val sequences, decoded together as one batch
+seq_len = 0 # tokens per sequence, 0 for 3 * block_size
+device = 'cpu'
+dtype = 'float32' # 'float32' or 'bfloat16' or 'float16'
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+@torch.no_grad()
+def score(model, tokens, window_stride):
+    """ Summed nll of tokens[:, block_size:] decoding with window_stride, and the seconds it took. """
+    block_size = model.config.block_size
+    kv_cache = model.make_kv_cache()
+    window_start, nll = 0, 0.0
+    t0 = time.perf_counter()
+    for i in range(block_size, tokens.size(1)):
+        with ctx:
+            logits, window_start = model.next_logits(tokens[:, :i], kv_cache, window_start, window_stride)
+        nll += F.cross_entropy(logits[:, -1, :].float(), tokens[:, i], reduction='sum').item()
+    return nll, time.perf_counter() - t0
+
+if __name__ == "__main__":
+    device_type = 'cuda' if 'cuda' in device else 'cpu'
+    ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
+    ctx = torch.amp.autocast(device_type=device_type, dtype=ptdtype, enabled=dtype != 'float32')
+    model, _ = load_model(os.path.join(out_dir, 'model.pt'), device)
+    block_size = model.config.block_size
+    seq_len = seq_len or 3 * block_size
+
+    token_dtype = 'uint16'
+    meta_path = os.path.join(dataset, 'meta.pkl')
+    if os.path.exists(meta_path):
+        with open(meta_path, 'rb') as f:
+            token_dtype = pickle.load(f).get('dtype', token_dtype)
+    # windows of seq_len+1 tokens spread evenly over the val split
+    if multi_file_dataset:
+        val = ShardedDataset(os.path.join(dataset, 'val'), load_manifest(dataset, token_dtype)['val'], seq_len, token_dtype)
+    else:
+        val = ShardedDataset.from_single_file(os.path.join(dataset, 'val.bin'), seq_len, token_dtype)
+    tokens = val.read(val.spread(num_sequences)).to(device)
+    num_scored = tokens.size(0) * (tokens.size(1) - block_size)
+    print(f"scoring {num_scored:,} tokens: positions {block_size} to {seq_len} of {tokens.size(0)} val sequences")
+
+    baseline = None
+    print(f"{'window_stride':>13} {'context':>10} {'val ppl':>9} {'ppl drift':>9} {'tokens/s':>9} {'speedup':>8}")
+    for window_stride in (int(s) for s in strides.split()):
+        nll, seconds = score(model, tokens, window_stride)
+        ppl, tokens_per_s = math.exp(nll / num_scored), num_scored / seconds
+        baseline = baseline or (ppl, tokens_per_s)
+        context = f"{block_size - window_stride}-{block_size}" if window_stride > 0 else f"{block_size}"
+        print(f"{window_stride:>13} {context:>10} {ppl:>9.3f} {(ppl / baseline[0] - 1) * 100:>8.2f}% {tokens_per_s:>9.1f} {tokens_per_s / baseline[1]:>7.2f}x")
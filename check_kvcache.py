@@ -0,0 +1,103 @@
+"""
+Checks that decoding with the KV caches of model.py gives the same logits and, at a fixed seed,
+the same sampled tokens as the uncached full-sequence forwards, on both the scaled_dot_product_attention
+and the manual attention path: KVCache in generate (prompts shorter than, equal to and longer than
+block_size), KVCache.crop (speculative decoding), prefix loading (PrefixCache) and SlotKVCache
+(continuous batching in serve.py). Small random models on the cpu, takes a few seconds.
+$ python check_kvcache.py
+"""
+import torch
+
+from model import GPTConfig, GPT, PrefixCache
+
+block_size = 32
+vocab_size = 64
+atol = 1e-5
+
+def make_model(flash):
+    torch.manual_seed(1337)
+    model = GPT(GPTConfig(n_layer=2, n_head=2, n_embd=32, block_size=block_size, vocab_size=vocab_size, dropout=0.0))
+    if not flash:
+        for block in model.transformer.h:
+            block.attn.flash = False
+            block.attn.register_buffer("bias", torch.tril(torch.ones(block_size, block_size)).view(1, 1, block_size, block_size))
+    return model.eval()
+
+def reference_logits(model, idx):
+    # logits of the last position, forwarding the last block_size tokens without a cache
+    logits, _ = model(idx[:, -block_size:])
+    return logits[:, -1, :]
+
+def check_close(name, a, b):
+    err = (a - b).abs().max().item()
+    assert err < atol, f"{name}: max abs difference {err:.2e}"
+
+def check_generate(model):
+    # every cached step against the uncached forward, then whole samples at a fixed seed
+    for prompt_len in (5, block_size, block_size + 7):
+        idx = torch.randint(vocab_size, (3, prompt_len))
+        kv_cache = model.make_kv_cache()
+        window_start = 0
+        for _ in range(block_size // 2):
+            logits, window_start = model.next_logits(idx, kv_cache, window_start)
+            check_close(f"generate step, prompt of {prompt_len}", logits[:, -1, :], reference_logits(model, idx))
+            idx = torch.cat((idx, logits[:, -1, :].argmax(-1, keepdim=True)), dim=1)
+        torch.manual_seed(42)
+        cached = model.generate(idx[:, :prompt_len], 20, top_k=10, use_cache=True)
+        torch.manual_seed(42)
+        uncached = model.generate(idx[:, :prompt_len], 20, top_k=10, use_cache=False)
+        assert torch.equal(cached, uncached), f"generate, prompt of {prompt_len}: cached and uncached samples differ"
+
+def check_crop(model):
+    # roll the cache back like generate_speculative does and continue with other tokens
+    idx = torch.randint(vocab_size, (1, 12))
+    kv_cache = model.make_kv_cache()
+    model(idx, kv_cache=kv_cache)
+    model(torch.randint(vocab_size, (1, 4)), kv_cache=kv_cache) # rejected drafts
+    kv_cache.crop(idx.size(1))
+    new = torch.randint(vocab_size, (1, 3))
+    logits, _ = model(new, kv_cache=kv_cache, num_logits=3)
+    ref, _ = model(torch.cat((idx, new), dim=1), num_logits=3)
+    check_close("crop", logits, ref)
+
+def check_prefix(model):
+    prefix_cache = PrefixCache(2**30, chunk_size=4)
+    preamble = torch.randint(vocab_size, (1, 13))
+    for i in range(3):
+        idx = torch.cat((preamble, torch.randint(vocab_size, (1, 5))), dim=1)
+        torch.manual_seed(i)
+        with_prefix = model.generate(idx.repeat(2, 1), 10, top_k=10, prefix_cache=prefix_cache)
+        torch.manual_seed(i)
+        without = model.generate(idx.repeat(2, 1), 10, top_k=10)
+        assert torch.equal(with_prefix, without), "generate with a prefix cache differs"
+    assert prefix_cache.counters['saved_prefill_tokens'] == 2 * 12, prefix_cache.stats()
+
+def check_slots(model):
+    # a slot reused after a stale sequence, rows at different lengths, a prefix loaded into a slot
+    cache = model.make_slot_kv_cache(3)
+    model(torch.randint(vocab_size, (1, 20)), kv_cache=cache.select([2]))
+    cache.free(2)
+    seqs = {0: torch.randint(vocab_size, (1, 7)), 2: torch.randint(vocab_size, (1, 3))}
+    for slot, idx in seqs.items():
+        logits, _ = model(idx, kv_cache=cache.select([slot]))
+        check_close("slot prefill", logits[:, -1, :], reference_logits(model, idx))
+    kv_cache = model.make_kv_cache()
+    seqs[1] = torch.randint(vocab_size, (1, 9))
+    model(seqs[1], kv_cache=kv_cache)
+    cache.load_prefix(kv_cache.read_prefix(9), 1)
+    for _ in range(10):
+        slots = [2, 0, 1]
+        new = torch.randint(vocab_size, (len(slots), 1))
+        logits, _ = model(new, kv_cache=cache.select(slots))
+        for i, slot in enumerate(slots):
+            seqs[slot] = torch.cat((seqs[slot], new[i:i+1]), dim=1)
+            check_close(f"slot {slot} decode", logits[i:i+1, -1, :], reference_logits(model, seqs[slot]))
+
+if __name__ == "__main__":
+    with torch.no_grad():
+        for flash in (True, False):
+            model = make_model(flash)
+            for check in (check_generate, check_crop, check_prefix, check_slots):
+                check(model)
+                print(f"{'sdpa' if flash else 'manual'} attention: {check.__name__} ok")
+    print("all KV cache checks passed")
@@ -0,0 +1,187 @@
+"""
+Checkpoint writing for train.py. A checkpoint is first snapshotted to host memory, which is quick,
+and then serialized by a background thread while training continues. Every write goes to a
+temporary file that is atomically renamed over ckpt.pt, so a crash mid-save never destroys the
+previous checkpoint. Optionally the last N and the best K (by val loss) checkpoints are kept as
+ckpt-<iter>-<val loss>.pt, hard links of the ckpt.pt they were written as.
+
+It also holds the inference artifact written by export.py: just the weights, cast to the inference
+dtype, the model args and the tokenizer path. load_model memory-maps it and assigns the weights
+straight into a model built on the meta device, skipping the random init of a fresh GPT.
+"""
+
+import os
+import re
+import queue
+import shutil
+import threading
+from contextlib import contextmanager
+
+import torch
+
+from model import GPTConfig, GPT
+
+def snapshot(obj, buffers=None, memo=None):
+    """
+    Copy every tensor in a (nested) checkpoint dict to host memory, so training can go on mutating
+    the originals. The host tensors of a previous snapshot of the same structure are reused if given.
+    Aliases of one tensor (the tied wte and lm_head weights) share one host tensor, so torch.save
+    still writes them once.
+    """
+    memo = {} if memo is None else memo
+    if torch.is_tensor(obj):
+        key = (obj.untyped_storage().data_ptr(), obj.storage_offset(), obj.shape, obj.stride(), obj.dtype)
+        if key not in memo:
+            if not (torch.is_tensor(buffers) and buffers.shape == obj.shape and buffers.dtype == obj.dtype):
+                buffers = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=obj.is_cuda)
+            memo[key] = buffers.copy_(obj.detach(), non_blocking=obj.is_cuda)
+        return memo[key]
+    if isinstance(obj, dict):
+        buffers = buffers if isinstance(buffers, dict) else {}
+        return {k: snapshot(v, buffers.get(k), memo) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        buffers = buffers if isinstance(buffers, (list, tuple)) and len(buffers) == len(obj) else [None] * len(obj)
+        return type(obj)(snapshot(v, b, memo) for v, b in zip(obj, buffers))
+    return obj
+
+class CheckpointWriter:
+
+    pattern = re.compile(r'^ckpt-(\d+)-([0-9.]+|inf|nan)\.pt$')
+
+    def __init__(self, out_dir, keep_last=0, keep_best=0, background=True):
+        self.out_dir = out_dir
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.background = background
+        self.error = None
+        self.buffers = None # host tensors of the last snapshot, reused by the next one
+        # at most one write in flight, save() waits for the previous one before reusing its buffers
+        self.queue = queue.Queue(maxsize=1)
+        if background:
+            self.thread = threading.Thread(target=self._worker, daemon=True)
+            self.thread.start()
+
+    def save(self, checkpoint, iter_num, val_loss):
+        if self.background:
+            self.queue.join()
+        self._raise_error()
+        self.buffers = snapshot(checkpoint, self.buffers)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize() # the device to host copies are non_blocking
+        item = (self.buffers, iter_num, float(val_loss))
+        if self.background:
+            self.queue.put(item)
+        else:
+            self._write(*item)
+
+    def close(self):
+        """ Wait for the pending write to finish. """
+        if self.background:
+            self.queue.put(None)
+            self.thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("writing the previous checkpoint failed") from error
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                self._write(*item)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _write(self, checkpoint, iter_num, val_loss):
+        path = os.path.join(self.out_dir, 'ckpt.pt')
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            torch.save(checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        if self.keep_last > 0 or self.keep_best > 0:
+            kept_path = os.path.join(self.out_dir, f'ckpt-{iter_num:07d}-{val_loss:.4f}.pt')
+            try:
+                os.link(path, kept_path)
+            except OSError:
+                shutil.copyfile(path, kept_path) # file system without hard links
+            self._prune()
+
+    def _prune(self):
+        kept = []
+        for name in os.listdir(self.out_dir):
+            m = self.pattern.match(name)
+            if m:
+                kept.append((int(m.group(1)), float(m.group(2)), name))
+        keep = set(name for _, _, name in sorted(kept)[-self.keep_last:]) if self.keep_last > 0 else set()
+        if self.keep_best > 0:
+            keep |= set(name for _, _, name in sorted(kept, key=lambda c: c[1])[:self.keep_best])
+        for _, _, name in kept:
+            if name not in keep:
+                os.remove(os.path.join(self.out_dir, name))
+
+def clean_state_dict(state_dict):
+    """ Strip the '_orig_mod.' prefix that torch.compile'd models leave on the keys. """
+    unwanted_prefix = '_orig_mod.'
+    return {k[len(unwanted_prefix):] if k.startswith(unwanted_prefix) else k: v for k, v in state_dict.items()}
+
+def export_model(checkpoint, path, dtype=torch.bfloat16, tokenizer=None):
+    """
+    Write the inference artifact of a training checkpoint: its model weights with floating point
+    tensors cast to dtype, its model_args and the tokenizer path. The optimizer state is dropped.
+    """
+    state_dict = {}
+    cast = {} # keeps tied weights (wte and lm_head) sharing one tensor in the artifact
+    for k, v in clean_state_dict(checkpoint['model']).items():
+        key = (v.untyped_storage().data_ptr(), v.storage_offset(), v.shape)
+        if key not in cast:
+            cast[key] = v.to(dtype) if v.is_floating_point() else v
+        state_dict[k] = cast[key].contiguous()
+    artifact = {
+        'model': state_dict,
+        'model_args': checkpoint['model_args'],
+        'tokenizer': tokenizer,
+        'dtype': str(dtype).split('.')[-1],
+    }
+    tmp_path = path + '.tmp'
+    torch.save(artifact, tmp_path)
+    os.replace(tmp_path, path)
+    return artifact
+
+@contextmanager
+def empty_init():
+    """
+    Build modules on the meta device with their random init skipped, for weights that are assigned
+    afterwards. Skipping matters even on meta: normal_ has no native meta kernel and its first call
+    imports torch._dynamo, which takes seconds.
+    """
+    names = ('normal_', 'uniform_', 'kaiming_uniform_', 'zeros_', 'ones_')
+    saved = {name: getattr(torch.nn.init, name) for name in names}
+    for name in names:
+        setattr(torch.nn.init, name, lambda tensor, *args, **kwargs: tensor)
+    try:
+        with torch.device('meta'):
+            yield
+    finally:
+        for name, fn in saved.items():
+            setattr(torch.nn.init, name, fn)
+
+def load_model(path, device='cpu'):
+    """
+    Load an inference artifact written by export_model, returns (model, artifact). The file is
+    memory-mapped, so on the cpu the weights are paged in on first use and shared between processes.
+    """
+    artifact = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    with empty_init():
+        model = GPT(GPTConfig(**artifact['model_args']))
+    model.load_state_dict(artifact['model'], assign=True)
+    model.transformer.wte.weight = model.lm_head.weight # assign replaced both halves of the tied pair
+    model.eval()
+    return model.to(device), artifact
@@ -0,0 +1,65 @@
+import argparse
+import json
+import os
+import random
+import re
+import time
+import unidecode
+from wikiclean import clean_text, ALL_OTHER_CHARS
+
+# benchmarks wikiclean.clean_text against the original per-function cleaning of parse-wikidump.py
+# and checks that both produce identical output, on extracted wikidump json files or synthetic text
+
+# original implementation, kept here as the reference
+def reference_clean_text(text):
+    new_text = ''
+    for char in text:
+        new_text += char
+    replaced_accents = unidecode.unidecode(new_text)
+    most_asian_chars = r'[\u3000-\u303F\u3040-\u309F\u30A0-\u30FF\u3100-\u312F\u3400-\u4DBF\u4E00-\u9FFF\uF900-\uFAFF\uFE30-\uFE4F\uFF00-\uFFEF]'
+    all_other_chars = r'[' + ALL_OTHER_CHARS + ']'
+    removed_non_english_chars = re.sub(all_other_chars, '', re.sub(most_asian_chars, '', replaced_accents))
+    removed_brace_commas = re.sub(r'(?<=\s)[,.;:]+(?=\s)', '', removed_non_english_chars)
+    removed_empty_braces = re.sub(r'\((?:[^\w\s\n]|[ \t])*\)', '', removed_brace_commas)
+    return re.sub(r'\s{2,}', ' ', removed_empty_braces)
+
+# wikipedia-like text that exercises every cleaning rule
+def synthetic_articles(num_articles, seed=1337):
+    rng = random.Random(seed)
+    words = ['the', 'city', 'river', 'was', 'founded', 'in', 'and', 'population', 'km', 'of', 'Zurich',
+             'café', 'Málaga', 'Łódź', 'naïve', 'Straße', 'Ελλάδα', 'Москва', '東京', '서울', 'ᚠᚢᚦ',
+             '(', ')', '()', '( , )', '(;)', ' , ', ' ; ', ' . ', ':', '—', '“quoted”', '\n', '\n\n', '\t']
+    return [' '.join(rng.choice(words) for _ in range(rng.randint(50, 2000))) for _ in range(num_articles)]
+
+def load_articles(input_dir):
+    articles = []
+    for file in sorted(os.listdir(input_dir)):
+        with open(os.path.join(input_dir, file), "r", encoding="utf-8", errors="ignore") as f:
+            articles.extend(json.loads(line)["text"] for line in f)
+    return articles
+
+def throughput(fn, articles, num_bytes):
+    t0 = time.time()
+    outputs = [fn(text) for text in articles]
+    dt = time.time() - t0
+    return outputs, num_bytes / dt / 1e6
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_dir", default=None, help="directory of extracted wikidump json files")
+    parser.add_argument("--num_articles", type=int, default=2000, help="synthetic articles if no input_dir")
+    args = parser.parse_args()
+
+    articles = load_articles(args.input_dir) if args.input_dir else synthetic_articles(args.num_articles)
+    num_bytes = sum(len(text.encode("utf-8")) for text in articles)
+    print(f"{len(articles):,} articles, {num_bytes/1e6:.2f} MB")
+
+    # both run in this single process, so MB/s is per core
+    reference, reference_mbs = throughput(reference_clean_text, articles, num_bytes)
+    cleaned, cleaned_mbs = throughput(clean_text, articles, num_bytes)
+    mismatches = sum(a != b for a, b in zip(reference, cleaned))
+    print(f"reference: {reference_mbs:.2f} MB/s per core")
+    print(f"clean_text: {cleaned_mbs:.2f} MB/s per core ({cleaned_mbs/reference_mbs:.2f}x)")
+    print(f"identical output: {mismatches == 0} ({mismatches} mismatching articles)")
+    if mismatches:
+        exit(1)
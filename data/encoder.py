@@ -0,0 +1,77 @@
+import os
+import random
+import numpy as np
+from tokenizers import normalizers, Tokenizer, trainers, pre_tokenizers, models
+
+# bpe encoding helpers shared by the data preparation scripts
+# each worker process loads the tokenizer once and encodes whole files in large
+# whitespace-aligned chunks with the library's batch encoder
+
+tokenizer = None
+
+# untrained bpe tokenizer and its trainer, as used by all the data preparation scripts
+def new_tokenizer(vocab_size):
+    tokenizer = Tokenizer(models.BPE())
+    # Normalize data by removing accents, and lowercasing all characters
+    tokenizer.normalizer = normalizers.Sequence([normalizers.StripAccents(), normalizers.Lowercase()])
+    # Encodes all whitespaces with special token “▁” (U+2581) at the start of each word
+    # This makes it easier to reconstruct sentences
+    tokenizer.pre_tokenizer = pre_tokenizers.Sequence([pre_tokenizers.Metaspace(), pre_tokenizers.Punctuation()])
+    trainer = trainers.BpeTrainer(vocab_size=vocab_size, special_tokens=["<PAD>", "<UNK>", "<BOS>", "<EOS>"])
+    return tokenizer, trainer
+
+# reproducible stratified sample of about sample_bytes of text for tokenizer training
+# every file contributes in proportion to its size, as windows of up to window_bytes read at
+# seeded random offsets and trimmed to whole words, so training cost no longer grows with the corpus
+def sample_text(filepaths, sample_bytes, seed=1337, window_bytes=1 << 20):
+    rng = random.Random(seed)
+    sizes = [os.path.getsize(path) for path in filepaths]
+    total = sum(sizes)
+    for path, size in zip(filepaths, sizes):
+        quota = round(sample_bytes * size / total) if total > 0 else 0
+        if quota == 0:
+            continue
+        if quota >= size:
+            offsets, length = [0], size
+        else:
+            length = min(window_bytes, quota)
+            num_windows = -(-quota // length)
+            offsets = sorted(rng.sample(range(size - length + 1), min(num_windows, size - length + 1)))
+        with open(path, 'rb') as f:
+            for offset in offsets:
+                f.seek(offset)
+                text = f.read(length).decode('utf-8', errors='ignore')
+                if length < size:
+                    # windows start and end mid-word, keep only the whole words in between
+                    text = text[text.find(' ') + 1:text.rfind(' ')]
+                yield text
+
+# process pool initializer, loads the tokenizer once per worker
+def init_worker(tokenizer_path):
+    global tokenizer
+    tokenizer = Tokenizer.from_file(tokenizer_path)
+
+# splits text into chunks of roughly chunk_size characters, cutting only right before a space
+# the Metaspace pre-tokenizer turns that space into the "▁" that starts the next word, so
+# encoding the chunks separately gives exactly the same ids as encoding the whole text
+def split_text(text, chunk_size=1 << 20):
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = text.find(' ', start + chunk_size)
+        if end == -1:
+            end = len(text)
+        chunks.append(text[start:end])
+        start = end
+    return chunks
+
+# encodes text into a numpy array of token ids, without building an intermediate python list
+def encode_text(text, dtype=np.uint16, chunk_size=1 << 20):
+    encodings = tokenizer.encode_batch(split_text(text, chunk_size))
+    ids = np.empty(sum(len(enc) for enc in encodings), dtype=dtype)
+    offset = 0
+    for enc in encodings:
+        n = len(enc)
+        ids[offset:offset+n] = enc.ids
+        offset += n
+    return ids
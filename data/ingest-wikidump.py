@@ -0,0 +1,120 @@
+import argparse
+import json
+import os
+import pickle
+import shutil
+import multiprocessing
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import encoder
+from encoder import new_tokenizer, init_worker, encode_text
+from shards import ShardWriter, token_dtype, bounded_map, write_manifest
+from wikiclean import clean_text
+
+# streams raw WikiExtractor json output straight into train/val token shards, replacing the
+# normalize-wikidump.py -> parse-wikidump.py -> prepare-bpe.py chain of intermediate files.
+# each worker process reads one extractor file, cleans and encodes it in memory, and the main
+# process appends the ids to fixed-size shards. only a bounded number of files is in flight
+# at any time, so memory stays flat however large the dump is
+
+parser = argparse.ArgumentParser()
+parser.add_argument("input_dir", help="WikiExtractor --json output directory (e.g. containing AA/wiki_00)")
+parser.add_argument("output_dir")
+parser.add_argument("--vocab_size", type=int, default=None, help="train a new tokenizer with this vocab size")
+parser.add_argument("--tokenizer", default=None, help="use an existing tokenizer.json instead of training one")
+parser.add_argument("--shard_tokens", type=int, default=100_000_000, help="tokens per output shard")
+parser.add_argument("--text_dir", default=None, help="also write the cleaned text of every input file here")
+parser.add_argument("--workers", type=int, default=max(multiprocessing.cpu_count() - 1, 1))
+args = parser.parse_args()
+
+# all extractor files below input_dir, in a stable order
+def list_input_files(input_dir):
+    files = []
+    for root, dirs, names in os.walk(input_dir):
+        dirs.sort()
+        files.extend(os.path.join(root, name) for name in sorted(names))
+    return files
+
+# reads one extractor file and returns its cleaned articles joined together, like parse-wikidump.py
+def clean_file(filepath):
+    with open(filepath, "r", encoding="utf-8", errors="ignore") as f:
+        return ''.join(clean_text(json.loads(line)["text"]) for line in f)
+
+# tokenizer training stream: a file that can't be read or parsed is left out rather than ending the run
+def clean_file_for_training(filepath):
+    try:
+        return clean_file(filepath)
+    except Exception as e:
+        print(f"Error cleaning {filepath}, skipped for tokenizer training: {e}")
+        return ''
+
+# run by each process in process pool: clean, optionally keep the text, encode and split 90/10
+# on failure the error message is returned instead and the file is skipped, like prepare-bpe.py
+def ingest_file(filepath, dtype):
+    try:
+        text = clean_file(filepath)
+        if args.text_dir is not None:
+            name = os.path.relpath(filepath, args.input_dir).replace(os.sep, '_')
+            with open(os.path.join(args.text_dir, f"{name}.txt"), "wb") as f:
+                f.write(text.encode("utf-8"))
+        ids = encode_text(text, dtype=dtype)
+        split = int(len(ids) * 0.9)
+        return ids[:split], ids[split:]
+    except Exception as e:
+        print(f"Error ingesting {filepath}: {e}")
+        return str(e)
+
+def train_tokenizer(files, vocab_size):
+    tokenizer, trainer = new_tokenizer(vocab_size)
+    with ProcessPoolExecutor(args.workers) as executor:
+        texts = bounded_map(executor, clean_file_for_training, files, 2 * args.workers)
+        tokenizer.train_from_iterator(texts, trainer=trainer, length=len(files))
+    return tokenizer
+
+if __name__ == "__main__":
+    assert (args.vocab_size is None) != (args.tokenizer is None), "pass exactly one of --vocab_size or --tokenizer"
+    os.makedirs(args.output_dir, exist_ok=True)
+    if args.text_dir is not None:
+        os.makedirs(args.text_dir, exist_ok=True)
+    files = list_input_files(args.input_dir)
+    print(f"Found {len(files):,} extractor files in {args.input_dir}")
+
+    tokenizer_path = os.path.join(args.output_dir, "tokenizer.json")
+    if args.tokenizer is not None:
+        if os.path.abspath(args.tokenizer) != os.path.abspath(tokenizer_path):
+            shutil.copyfile(args.tokenizer, tokenizer_path)
+        init_worker(tokenizer_path)
+        tokenizer = encoder.tokenizer
+    else:
+        print("Training tokenizer on the cleaned stream...\n")
+        tokenizer = train_tokenizer(files, args.vocab_size)
+        tokenizer.save(tokenizer_path)
+    vocab_size = tokenizer.get_vocab_size()
+    dtype = token_dtype(vocab_size)
+
+    meta = {
+    'vocab_size': vocab_size,
+    'tokenizer': tokenizer_path,
+    'dtype': np.dtype(dtype).name,
+    }
+    print(f"Total vocab size: {vocab_size}, token dtype: {np.dtype(dtype).name}")
+    with open(os.path.join(args.output_dir, "meta.pkl"), 'wb') as meta_f:
+        pickle.dump(meta, meta_f)
+
+    print("Cleaning, encoding and sharding...\n")
+    writers = {split: ShardWriter(os.path.join(args.output_dir, split), args.shard_tokens, dtype) for split in ('train', 'val')}
+    failed = []
+    with ProcessPoolExecutor(args.workers, initializer=init_worker, initargs=(tokenizer_path,)) as executor:
+        for i, (filepath, result) in enumerate(zip(files, bounded_map(executor, partial(ingest_file, dtype=dtype), files, 2 * args.workers))):
+            if isinstance(result, str):
+                failed.append(filepath)
+            else:
+                writers['train'].write(result[0])
+                writers['val'].write(result[1])
+            if (i + 1) % 100 == 0 or i + 1 == len(files):
+                print(f"{i + 1:,}/{len(files):,} files, {writers['train'].num_tokens:,} train tokens, {writers['val'].num_tokens:,} val tokens")
+
+    write_manifest(args.output_dir, {split: writer.close() for split, writer in writers.items()})
+    if failed:
+        print(f"{len(failed):,} files failed and were skipped: {', '.join(failed)}")
@@ -1,15 +1,22 @@
 import argparse
 import os
+import time
 import pickle
 import numpy as np
 import multiprocessing
-from tokenizers import normalizers, Tokenizer, trainers, pre_tokenizers, models, decoders
-from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from encoder import new_tokenizer, sample_text, init_worker, encode_text
+from shards import ShardWriter, token_dtype, bounded_map, file_hash, write_manifest
+from tokenizers import Tokenizer
 
 parser = argparse.ArgumentParser()
 parser.add_argument("input_dir")
 parser.add_argument("output_dir")
 parser.add_argument("vocab_size", type=int)
+parser.add_argument("--sample_bytes", type=int, default=0, help="train the tokenizer on a sample of about this many bytes (0 = all files)")
+parser.add_argument("--seed", type=int, default=1337, help="seed of the tokenizer training sample")
+parser.add_argument("--shard_tokens", type=int, default=100_000_000, help="tokens per output shard")
 args = parser.parse_args()
 
 if not os.path.exists(args.output_dir):
@@ -21,85 +28,173 @@ if not os.path.exists(train_dir):
 if not os.path.exists(val_dir):
     os.mkdir(val_dir)
 
-# run by each thread in thread pool
-def encode_chunk(chunk):
-    tokenizer = Tokenizer.from_file(os.path.join(args.output_dir, "tokenizer.json"))
-    return tokenizer.encode(chunk).ids
+# the state of previous runs: which inputs (by content hash) went into which shards, with which tokenizer
+# it is rewritten atomically after every completed shard, so a crashed run loses at most the shard in progress
+def new_state(tokenizer_hash, dtype):
+    return {'tokenizer_hash': tokenizer_hash, 'dtype': dtype, 'inputs': {}, 'failed': {}, 'shards': {'train': [], 'val': []}}
 
-# run by each process in process pool
-def prepare_files(filename):
+def load_state(path):
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    return new_state(None, None)
+
+def save_state(path, state):
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(state, f)
+    os.replace(path + '.tmp', path)
+    # the manifest only lists committed shards, with offsets into the concatenated split
+    manifest = {}
+    for split, shards in state['shards'].items():
+        offset, manifest[split] = 0, []
+        for shard in shards:
+            manifest[split].append({'name': shard['name'], 'num_tokens': shard['num_tokens'], 'offset': offset})
+            offset += shard['num_tokens']
+    write_manifest(args.output_dir, manifest)
+
+# run by each process in process pool, the tokenizer is loaded once per process by init_worker
+# returns the train and val ids of one file, which the main process appends to the shards,
+# or the error message if the file could not be encoded
+def prepare_files(filename, dtype):
     filepath = os.path.join(args.input_dir, filename)
-    base_name = os.path.splitext(filename)[0]
-    encoded_data = list()
-    if os.path.isfile(filepath) and not filename.startswith(('meta', 'train', 'input', 'val', 'unique_tokens')):
+    try:
         with open(filepath, 'r', encoding="utf-8", errors="ignore") as f:
-            chunks = []
-            while True:
-                chunk = f.read(4096)  # Adjust the buffer size if needed
-                if not chunk:
-                    break
-                chunks.append(chunk)
-
-            # distribute the encoding work across multiple threads
-            with ThreadPoolExecutor() as executor:
-                encoded_chunks = list(executor.map(encode_chunk, chunks))
-            try:
-                for enc in encoded_chunks:
-                    encoded_data.extend(enc)
-
-                num_tokens = len(encoded_data)
-                print(f"{os.path.basename(filename)}: {num_tokens:,} tokens")
-                    
-                # create the train and test splits
-                train_ids = encoded_data[:int(num_tokens*0.9)]
-                val_ids = encoded_data[int(num_tokens*0.9):]
-                print(f"Encoding {filepath}! train length: {len(train_ids):,}, val length: {len(val_ids):,}")
-
-                # export to bin files
-                train_ids = np.array(train_ids, dtype=np.uint16)
-                val_ids = np.array(val_ids, dtype=np.uint16)
-                train_ids.tofile(os.path.join(train_dir, f"{base_name}.bin"))
-                val_ids.tofile(os.path.join(val_dir, f"{base_name}.bin"))
-            except Exception as e:
-                print(f"Error encoding {filepath}: {e}")
-        
+            encoded_data = encode_text(f.read(), dtype=dtype)
+
+        num_tokens = len(encoded_data)
+        print(f"{os.path.basename(filename)}: {num_tokens:,} tokens")
+
+        # create the train and test splits
+        train_ids = encoded_data[:int(num_tokens*0.9)]
+        val_ids = encoded_data[int(num_tokens*0.9):]
+        print(f"Encoding {filepath}! train length: {len(train_ids):,}, val length: {len(val_ids):,}")
+        return train_ids, val_ids
+    except Exception as e:
+        print(f"Error encoding {filepath}: {e}")
+        return str(e)
+
 if __name__ == "__main__":
-    print("Training tokenizer...\n")
-    files = os.listdir(args.input_dir)
+    files = sorted(f for f in os.listdir(args.input_dir) if os.path.isfile(os.path.join(args.input_dir, f))
+                   and not f.startswith(('meta', 'train', 'input', 'val', 'unique_tokens')))
     files_with_dir = [os.path.join(args.input_dir, file) for file in files]
-    files = files
-    tokenizer = Tokenizer(models.BPE())
-    # Normalize data by removing accents, and lowercasing all characters
-    tokenizer.normalizer = normalizers.Sequence([normalizers.StripAccents(), normalizers.Lowercase()])
-    # Encodes all whitespaces with special token “▁” (U+2581) at the start of each word
-    # This makes it easier to reconstruct sentences
-    tokenizer.pre_tokenizer = pre_tokenizers.Sequence([pre_tokenizers.Metaspace(), pre_tokenizers.Punctuation()])
-    trainer = trainers.BpeTrainer(vocab_size=args.vocab_size, special_tokens=["<PAD>", "<UNK>", "<BOS>", "<EOS>"])
-    tokenizer.train(files_with_dir, trainer=trainer)
-
-    print("Saving metadata and trained tokenizer...\n")
-    tokenizer.save(os.path.join(args.output_dir, "tokenizer.json"))
+    tokenizer_path = os.path.join(args.output_dir, "tokenizer.json")
+    if os.path.exists(tokenizer_path):
+        # delete tokenizer.json to retrain, which also re-encodes everything
+        print(f"Reusing existing tokenizer {tokenizer_path}\n")
+        tokenizer = Tokenizer.from_file(tokenizer_path)
+        assert tokenizer.get_vocab_size() <= args.vocab_size, f"{tokenizer_path} has a larger vocab than {args.vocab_size}"
+    else:
+        print("Training tokenizer...\n")
+        tokenizer, trainer = new_tokenizer(args.vocab_size)
+        t0 = time.time()
+        if args.sample_bytes > 0:
+            # stream a reproducible sample instead of scanning the whole corpus
+            sample_size = 0
+            def counted(texts):
+                global sample_size
+                for text in texts:
+                    sample_size += len(text)
+                    yield text
+            tokenizer.train_from_iterator(counted(sample_text(files_with_dir, args.sample_bytes, args.seed)), trainer=trainer)
+            print(f"Trained tokenizer on a {sample_size:,} character sample (seed {args.seed}) in {time.time() - t0:.1f}s")
+        else:
+            tokenizer.train(files_with_dir, trainer=trainer)
+            print(f"Trained tokenizer on all {len(files):,} files in {time.time() - t0:.1f}s")
+
+        print("Saving trained tokenizer...\n")
+        tokenizer.save(tokenizer_path)
+
+    print("Saving metadata...\n")
+    # uint16 silently wraps ids above 65535, so larger vocabularies are stored as uint32
+    dtype = token_dtype(args.vocab_size)
     meta = {
     'vocab_size': args.vocab_size,
-    'tokenizer': os.path.join(args.output_dir, "tokenizer.json"),
+    'tokenizer': tokenizer_path,
+    'dtype': np.dtype(dtype).name,
     }
-    print(f"Total vocab size: {args.vocab_size}")
+    print(f"Total vocab size: {args.vocab_size}, token dtype: {np.dtype(dtype).name}")
     with open(os.path.join(args.output_dir, f"meta.pkl"), 'wb') as meta_f:
         pickle.dump(meta, meta_f)
 
-    print("Encoding train and validation files...\n")
     # distribute preparation work across multiple processes
     # use all but one of available cores (to avoid lockup lol)
-    max_processes = multiprocessing.cpu_count() - 1
+    max_processes = max(multiprocessing.cpu_count() - 1, 1)
+
+    print("Checking inputs against the previous run...\n")
+    state_path = os.path.join(args.output_dir, "sources.pkl")
+    state = load_state(state_path)
+    tokenizer_hash = file_hash(tokenizer_path)
+    if state['tokenizer_hash'] != tokenizer_hash or state['dtype'] != np.dtype(dtype).name:
+        # different tokenizer, none of the existing shards can be kept
+        state = new_state(tokenizer_hash, np.dtype(dtype).name)
     with ProcessPoolExecutor(max_processes) as executor:
-        executor.map(prepare_files, files)
+        hashes = dict(zip(files, executor.map(file_hash, files_with_dir)))
+    # a shard has to be rebuilt if any input in it was changed or removed, then all of its inputs are re-encoded.
+    # a re-encoded input drops its ids from every shard it was in (train and val, or several shards when
+    # it was larger than one), which makes those stale in turn, so this repeats until nothing changes
+    stale_shards = {'train': set(), 'val': set()}
+    def is_stale(record):
+        return any(stale_shards[split].intersection(record[split]) for split in ('train', 'val'))
+    stale_inputs = {f for f, r in state['inputs'].items() if hashes.get(f) != r['hash']}
+    while stale_inputs:
+        for filename in stale_inputs:
+            for split in ('train', 'val'):
+                stale_shards[split].update(state['inputs'][filename][split])
+        state['inputs'] = {f: r for f, r in state['inputs'].items() if f not in stale_inputs}
+        stale_inputs = {f for f, r in state['inputs'].items() if is_stale(r)}
+    for split in ('train', 'val'):
+        state['shards'][split] = [s for s in state['shards'][split] if s['name'] not in stale_shards[split]]
+    pending = [f for f in files if f not in state['inputs']]
+    retried = sum(f in state['failed'] for f in pending)
+    num_stale = sum(len(names) for names in stale_shards.values())
+    print(f"{len(files) - len(pending):,} inputs up to date, {len(pending):,} to encode ({retried:,} failed last time), {num_stale:,} stale shards")
+
+    # delete stale shards and leftovers of crashed runs, i.e. everything not committed to the state
+    next_index = {}
+    for split, split_dir in (('train', train_dir), ('val', val_dir)):
+        kept = {s['name'] for s in state['shards'][split]}
+        for name in os.listdir(split_dir):
+            if name.endswith('.bin') and name not in kept:
+                os.remove(os.path.join(split_dir, name))
+        next_index[split] = max((int(os.path.splitext(name)[0]) + 1 for name in kept), default=0)
+
+    print("Encoding train and validation files...\n")
+    # the ids of all pending files are packed, in file order, into new shards of at most shard_tokens tokens
+    # a file never straddles two shards (unless it is larger than a shard), so when the train shard
+    # fills up both splits start new shards and everything written so far can be committed
+    writers = {split: ShardWriter(os.path.join(args.output_dir, split), args.shard_tokens, dtype, next_index[split]) for split in ('train', 'val')}
+    uncommitted = {}
+    def commit():
+        for writer in writers.values():
+            writer.roll()
+        for split, writer in writers.items():
+            committed = {s['name'] for s in state['shards'][split]}
+            state['shards'][split] += [dict(s) for s in writer.shards if s['name'] not in committed]
+        state['inputs'].update(uncommitted)
+        uncommitted.clear()
+        save_state(state_path, state)
+    state['failed'] = {}
+    with ProcessPoolExecutor(max_processes, initializer=init_worker, initargs=(tokenizer_path,)) as executor:
+        for filename, result in zip(pending, bounded_map(executor, partial(prepare_files, dtype=dtype), pending, 2 * max_processes)):
+            if isinstance(result, str):
+                state['failed'][filename] = {'hash': hashes[filename], 'error': result}
+                continue
+            train_ids, val_ids = result
+            if not writers['train'].fits(len(train_ids)):
+                commit()
+            uncommitted[filename] = {'hash': hashes[filename], 'train': writers['train'].write(train_ids), 'val': writers['val'].write(val_ids)}
+    commit()
+    if state['failed']:
+        print(f"{len(state['failed']):,} inputs failed and will be retried on the next run: {', '.join(sorted(state['failed']))}")
 
+    if not state['shards']['train']:
+        exit()
     # do a sample decoding to make sure everything is working
-    sample_file = os.path.join(train_dir, "1.bin")
+    sample_file = os.path.join(train_dir, state['shards']['train'][0]['name'])
     print(f"Preparation complete! Decoded sample from {sample_file}: \n")
     with open(sample_file, 'r') as f:
-        data = np.fromfile(f, dtype=np.uint16)
+        data = np.fromfile(f, dtype=dtype)
         decoded_and_joined = (''.join(tokenizer.decode(data[:32]))).replace(' ', '')
         remove_extra_spaces = decoded_and_joined.replace('▁', ' ')
         print(remove_extra_spaces)
-    exit()
\ No newline at end of file
+    exit()
@@ -0,0 +1,90 @@
+import os
+import pickle
+import hashlib
+from collections import deque
+import numpy as np
+
+# writing of bin token shards and of the manifest.pkl that the trainer (dataloader.py) reads
+
+# smallest unsigned dtype that can hold every token id of the vocabulary
+def token_dtype(vocab_size):
+    return np.uint16 if vocab_size <= 2**16 else np.uint32
+
+# like executor.map, but keeps at most max_in_flight tasks (and their results) around at once
+# results come back in submission order, so the shards are written deterministically
+def bounded_map(executor, fn, items, max_in_flight):
+    in_flight = deque()
+    for item in items:
+        in_flight.append(executor.submit(fn, item))
+        if len(in_flight) >= max_in_flight:
+            yield in_flight.popleft().result()
+    while in_flight:
+        yield in_flight.popleft().result()
+
+# content hash of a file, read in 1MB blocks
+def file_hash(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+# appends token ids to numbered bin shards in split_dir, starting a new shard every shard_tokens tokens
+# shard numbering starts at first_index, so a rerun can add shards next to the existing ones
+class ShardWriter:
+    def __init__(self, split_dir, shard_tokens, dtype=np.uint16, first_index=0):
+        self.split_dir = split_dir
+        self.shard_tokens = shard_tokens
+        self.dtype = dtype
+        self.first_index = first_index
+        self.shards = [] # manifest entries of the shards written so far
+        self.num_tokens = 0 # total tokens written
+        self.file = None
+        os.makedirs(split_dir, exist_ok=True)
+
+    # whether num_tokens more tokens still fit into the shard that is currently open
+    def fits(self, num_tokens):
+        return self.file is None or self.shards[-1]['num_tokens'] + num_tokens <= self.shard_tokens
+
+    # closes the current shard early, the next write starts a new one
+    def roll(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    # returns the names of the shards the ids went into
+    def write(self, ids):
+        ids = np.asarray(ids, dtype=self.dtype)
+        names = []
+        while len(ids) > 0:
+            if self.file is None or self.shards[-1]['num_tokens'] == self.shard_tokens:
+                self._next_shard()
+            shard = self.shards[-1]
+            n = min(len(ids), self.shard_tokens - shard['num_tokens'])
+            ids[:n].tofile(self.file)
+            shard['num_tokens'] += n
+            self.num_tokens += n
+            ids = ids[n:]
+            names.append(shard['name'])
+        return names
+
+    def _next_shard(self):
+        if self.file is not None:
+            self.file.close()
+        name = f"{self.first_index + len(self.shards):06d}.bin"
+        self.file = open(os.path.join(self.split_dir, name), 'wb')
+        self.shards.append({'name': name, 'num_tokens': 0, 'offset': self.num_tokens})
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        return self.shards
+
+# records the name, token count and offset of every bin shard so the trainer
+# doesn't have to list the directories or stat the files on every batch
+def write_manifest(output_dir, manifest):
+    for split, shards in manifest.items():
+        print(f"{split}: {len(shards):,} shards, {sum(s['num_tokens'] for s in shards):,} tokens")
+    with open(os.path.join(output_dir, "manifest.pkl"), 'wb') as manifest_f:
+        pickle.dump(manifest, manifest_f)
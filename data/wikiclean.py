@@ -0,0 +1,49 @@
+import re
+import unidecode
+
+# text cleaning for extracted wikipedia dumps, used by parse-wikidump.py
+# all tables and patterns are built once at import instead of on every call
+
+# most CJK / fullwidth blocks, removed since they increase the vocabulary size too much
+MOST_ASIAN_CHAR_RANGES = [
+    (0x3000, 0x303F), (0x3040, 0x309F), (0x30A0, 0x30FF), (0x3100, 0x312F), (0x3400, 0x4DBF),
+    (0x4E00, 0x9FFF), (0xF900, 0xFAFF), (0xFE30, 0xFE4F), (0xFF00, 0xFFEF),
+]
+# all other non-english/latin characters seen in the dump
+# unidecode doesn't support many of these, and the rest are rare enough that they don't matter
+ALL_OTHER_CHARS = '☣☭☯☼♀♂♄♆♋♏♑♒♘♙♟♠♡♣♥♦♭♮♯⚥✓✚❤⟨⟩⨳⬱ⱡⲁⲓⲙⲟⲣⲫⲱⴀⴄⴈⴊⴌⴐⴒⴓⴕⴰⴱⴳⴷⴹⴻⴼⴽⵀⵃⵄⵅⵇⵉⵊⵍⵎⵏⵓⵔⵕⵖⵙⵚⵛⵜⵟⵡⵢⵣⵥⵯ⿰⿱⿺ㄱㄲㄴㄷㄸㄹㅁㅂㅃㅅㅆㅇㅈㅉㅊㅋㅌㅍㅎㅏㅐㅑㅒㅓㅔㅕㅖㅗㅘㅙㅚㅛㅜㅝㅞㅟㅠㅡㅢㅣ㎡ꙑꙥꙩꙭꙮꜧ꞉ꞌꞯꤷꤼꥁꦏꦑꦒꦔꦗꦠꦡꦢꦣꦩꦪꦫꦮꦯꦲ꧈ꭰꭲꭵꭶꭹꭿꮃꮅꮒꮕꮝꮧꮪꮳꮵꮻꮼꮿꯀꯁꯂꯃꯄꯅꯆꯇꯈꯉꯊꯋꯌꯍꯎꯏꯑꯔꯕꯖꯗꯛꯜꯝꯟꯠꯡꯢ꯱가각간감갑강같개거건걸겠경계고곡곤골곰공과관광괴교구국군굴궁권귀규균근글금기길김까꺄꼼꾼나난날남낮내너널녀년노놀농누늑능니님다단달담답당대더덕덤뎌도독돈동된두둥듀드들등디따때떡똥뜨라락란람랑래랙량럼렁레려령례로룡루르른를름리림립릿마막만말망매맥맹머먹먼멈메면명모목몽묘무묵문물뭏미민믿밀바박반발밤밥방배백버번벌범베변별병보복본볼봉부북분불브븐블비빛빠뻐뽀사산삼상새생샤서석선설성세션소속손송쇼수숙순술슈슐스슬슴습승시식신실심십싸쌈쌍썬쓰씨씽아안알암앙애앤야약양어억언얼엄었에엑엔여역연열영예오옥온옷옹와완왕왜외요용우운울웅워원월위윙유육윤율융으은을음응의이익인일임자잖잘장재쟁저전절점접젓정제조족종좋좌주죽준중즈지직진징짜쪽찌차찬찰참창채책처천철첩첫청쳐초촌총최추춘출춰츄치칠침카칵캐컨컴켜코콜콤쿵퀴크타탁탄탈탕태택탱터테텐토통투트특티틴팅파판패퍼페펙편평폐포푸풍프플피필핑하학한할합항해했향허헌헤혁현협형혜호홀홉홍화환황회횡효후훈훗훼휘휴흠흥희ﬁﷲﷺ﹔ﺍﺎﺏﺒﺠﺤﺩﺪﺮﺴﺷﻀﻁﻋﻓﻙﻞﻟﻠﻣﻨﻩﻫﻮﻲ￼�𐤁𐤂𐤋𐨐𐨤𐨪𐬀𐬌𐬨𐬫𑆑𑆫𑆯𑐣𑐰𒃶𒄩𒈛𒈣𒈨𝄆𝄇𝄫𞤢𞤣𞤤𞤥𞤪𞤫𞤭𞤲🇪🇸ᑦᒡᒪᓂᓄᓗᔨᔭᖃᖏᗸᘅ ᚁᚂᚃᚄᚅᚆᚇᚈᚉᚊᚋᚌᚍᚎᚏᚐᚑᚒᚓᚔᚕᚖᚗᚘᚙᚚ᚛᚜ᚠᚢᚦᚨᚱᚲᚾᛖᛟᜅᜇᜈᜉᜎᜑᝢᝤᝨᝫᝬᝮᝰកខគងចជញឌណតទនបពភមយរលសអឧ០១២៣៤៥៦៧៨៩ᱚᱞᱠᱤᱪᴖᴥآأؤإئابةتثجحخدذرزسشصضطظعغـفقكلمنهوىي١٢٤٥٦٧٨٩ٱٲٹٽپٿڄڅچڇڈڊڌڑڕژښڠڤکڬڭگڵںڻھہۆۇیێېےە۞ۥ۶۷܀ܐܒܓܕܗܘܙܚܛܝܟܠܡܢܣܥܦܨܩܪܫܬݢݣހށނރބކއވމފދތލގސޑޒޔޖޙޛޝޞޢޣޤߊߌߏߖߛߝߞߟߡߣअआइईउऊऋएओकखगघङचछजझञटठडणतथदधनपफबभमयरलळवशषसहऽ।॥०१२३६অআইঈউঊঋএঐওঔকখগঘঙচছজঝঞটঠডঢণতথদধনপফবভমযরলশষসহৎৰৱ৳ਅਈਔਕਖਘਚਜਟਣਤਦਨਪਫਬਮਰਲਵਸਹੜઈકગચછજઝટડતદનપબમયરલવશଇକଙଜଟତଦନମରଲଶସହୟஃஅஇஉஊஐகஙசஜஞடணதநனபமயரறலளழவఅఆఇఈఉఊఋఎఏఐఒఓఔకఖగఘఙచఛజఝఞటఠడఢణతథదధనపఫబభమయరఱలళవశషసహౠ౦౧౨౩౪౫౬౭౮౯ಕಗಜಟಡಣತನಪಬಭಮಯರಲಳವಶಸಹഅഇഉഐകഗങചജടണതദനപഭമയരറലളവശഷസഹൻർൽඅආඑකගජඤඥටඩණතදධනපබභමයරලවශෂසහกขคงจฉชซญฎฏฐฑฒณดตถทธนบปผฝพฟภมยรฤลวศษสหฬอฯะาำเแโใไ๏ກຄງຊຍດທນບຜພມລວສຫອຮະາຳເແໃໄ་།ཀཁགངཆཏཐདནཔཕབམཙཞཡརལསཧကခဂဃငစဆဈဉညဋဌဍဎဏတထဒဓနပဖဗဘမရလဝသဠ၀၁၂၃၄၅၆၇၈၉ၐၑაბგდევზთიკლმნოპჟრსტუფქღყშჩცძწჭხჯჰሀሁህለሊላልሎሐሓሔሕመማምሠረሪራርሮሰሱሳሴስቀቂቃቅበቡቢባብተታቴትቸኀነናንኖኛአኢኣከኩክኮወዊውዎዐዕዘዝየያይዮደዳዴድጃገጌግጎጠጦጰጵጸፀፈፍ¡¢£¤¥§¨©ª«¬­®¯°±²³´µ¶·¸¹º»¼½¾¿×ßàáâãäåæçèéêëìíîïðñòóôõö÷øùúûüýþÿāăąćĉċčďđēĕėęěĝğġģĥħĩīĭįıĵķĺļľłńņňŉŋōŏőœŕŗřśŝşšţťŧũūŭůűųŵŷźżžſƌƒơưƿǁǂǃǎǐǒǔǚǝǣǧǩǫǭǰǹǿșțȝȟȷɂɐɑɒɓɔɕɖɗɘəɛɜɝɟɠɡɣɤɥɦɧɨɪɫɬɮɯɲɳɵɶɸɹɺɾʀʁʂʃʄʇʈʊʋʌʎʏʐʑʒʔʕʘʛʤʦʧʰʱʲʳʷʸʹʻʼʽʾʿˀˁˆˇˈˊˋˌː˚˜˝ˡˣˤ˥˧˨˩˹˺̇άέήίαβγδεζηθικλμνξοπρςστυφχψωϊόύώϕϛϝϟϡϲϸϻабвгдежзийклмнопрстуфхцчшщъыьэюяѐёђѓєѕіїјљњћќѝўџѡѣѧѫѯѱѳҁҍҏґғқҡҧҫүұҷҹӆӈӏӑӗәӣӧөӱӳԁԙԝաբգդեզէըթժիլխծկհձղճմյնշոչպջռսվտրցւփքօֆև־אבגדהוזחטיךכלםמןנסעףפץצקרשתװ״،ءፐᐃᐅᐯᐸᑐᑕᵛᶻḇḋḍḏḓḗḡḥḩḫḭḱḳḵḷḻḽḿṁṃṅṇṉṋṓṗṙṛṟṣṧṫṭṯṱṿẁẋẏẓẕạảấầẩậắằẳẵặẹẻẽếềểễệỉịọỏốồổỗộớờởợụủứừửữựỳỹἀἁἄἅἐἑἔἕἠἡἥἰἱἴἶἷὀὁὄὅὐὑὔὕὖὠὤὦὰὴὶὸᾀᾱᾶῆ῏ῑῖῥῦῴῶ​‌‍‎‏‐‑‒–—―‖‘’‚“”„†‡•…‧ ‬‭ ‰′″›※‽‾‿⁄⁊⁠⁣⁴⁶⁻ⁿ₂₃ₚ₡₣₤₦₩₪₫€₱₵₹₺₽₿℃℅ℓℕ№ℚℜℝ℞℠™ℰ⅓⅔⅕⅛⅜⅝⅟ⅰⅱ←↑→↵⇔∀∂∃∆∇∈∉−∗∘√∛∝∞∪∫∴∼≈≒≔≠≡≤≥⊂⊃⊆⊇⊙⋅⌀⌂⌬⏣④ⓒⓢ─▁◊○●◦☃★☆☊☌☍🐓😊😎🤷􏿾'
+
+# str.translate table deleting every character above
+REMOVE_CHARS_TABLE = dict.fromkeys(
+    [c for lo, hi in MOST_ASIAN_CHAR_RANGES for c in range(lo, hi + 1)] + [ord(c) for c in ALL_OTHER_CHARS])
+
+# unidecode transliterates every character on its own, so transliterating and then removing
+# characters can be done by a single str.translate whose table maps each non-ascii character
+# to its cleaned transliteration. entries are filled in the first time a character is seen
+class CleaningTable(dict):
+    def __init__(self):
+        super().__init__((c, c) for c in range(128)) # ascii stays as it is
+
+    def __missing__(self, codepoint):
+        cleaned = unidecode.unidecode(chr(codepoint)).translate(REMOVE_CHARS_TABLE)
+        self[codepoint] = cleaned
+        return cleaned
+
+CLEANING_TABLE = CleaningTable()
+
+# floating punctuation marks (e.g. " ; ; " " , ") and braces without any letters inside
+# (e.g. "(         )" "()" "(,  )" "(.   ,*!@#$%^&*)"), both removed in the same pass.
+# the two never start at the same character and deleting the punctuation first could never
+# change whether a brace matches, so one scan gives the same result as two
+FLOATING_PUNCTUATION_OR_EMPTY_BRACES = re.compile(r'\((?:[^\w\s\n]|[ \t])*\)|(?<=\s)[,.;:]+(?=\s)')
+
+# after removing chars, there will be double spaces all over the place
+# removes double-newlines as well. this has to stay a separate pass after the removals,
+# since removing a brace can join the whitespace around it into one run
+DOUBLE_SPACES = re.compile(r'\s{2,}')
+
+# transliterate most non-latin characters to latin, drop the rest and tidy up the leftovers
+def clean_text(text):
+    text = text.translate(CLEANING_TABLE)
+    text = FLOATING_PUNCTUATION_OR_EMPTY_BRACES.sub('', text)
+    return DOUBLE_SPACES.sub(' ', text)
@@ -0,0 +1,274 @@
+"""
+Window data loading over memmapped token shards, used by train.py.
+A dataset split is either a single .bin file (Karpathy's original train.bin / val.bin layout)
+or a directory of .bin shards described by the manifest.pkl written by data/prepare-bpe.py.
+Training walks the windows in a seeded, resumable per-epoch order (EpochSampler), evaluation
+samples windows at random positions.
+"""
+
+import os
+import time
+import queue
+import pickle
+import threading
+from collections import OrderedDict, deque
+
+import numpy as np
+import torch
+
+def scan_shards(split_dir, dtype=np.uint16):
+    """ Build manifest entries for a directory of shards without a manifest (older datasets). """
+    itemsize = np.dtype(dtype).itemsize
+    shards, offset = [], 0
+    for name in sorted(os.listdir(split_dir)):
+        if not name.endswith('.bin'):
+            continue
+        num_tokens = os.path.getsize(os.path.join(split_dir, name)) // itemsize
+        shards.append({'name': name, 'num_tokens': num_tokens, 'offset': offset})
+        offset += num_tokens
+    return shards
+
+def load_manifest(data_dir, dtype=np.uint16):
+    """ Return {split: [{'name', 'num_tokens', 'offset'}, ...]}, falling back to a one-off directory scan. """
+    manifest_path = os.path.join(data_dir, 'manifest.pkl')
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'rb') as f:
+            return pickle.load(f)
+    print(f"no manifest found in {data_dir}, scanning shard directories once")
+    return {split: scan_shards(os.path.join(data_dir, split), dtype) for split in ('train', 'val')}
+
+class ShardedDataset:
+    """
+    Samples (x, y) windows of block_size tokens uniformly over all token positions of a split,
+    so a shard is picked with probability proportional to its usable length. Shards are memmapped
+    on first use and kept open in a small LRU table instead of being reopened for every row.
+    """
+
+    def __init__(self, split_dir, shards, block_size, dtype=np.uint16, max_open=512):
+        self.split_dir = split_dir
+        self.block_size = block_size
+        self.dtype = dtype
+        self.max_open = max_open
+        # only shards that hold at least one full (x, y) window can be sampled from
+        self.shards = [s for s in shards if s['num_tokens'] > block_size]
+        assert len(self.shards) > 0, f"no shard in {split_dir} is longer than block_size={block_size}"
+        # a window may start anywhere in [0, num_tokens - block_size) of its shard
+        starts = np.array([s['num_tokens'] - block_size for s in self.shards], dtype=np.int64)
+        self.cum_starts = np.cumsum(starts)
+        self.first_window = self.cum_starts - starts # global index of each shard's first window
+        self.num_windows = int(self.cum_starts[-1])
+        # an epoch reads the non-overlapping windows [j*block_size, (j+1)*block_size] of every shard
+        chunks = np.array([(s['num_tokens'] - 1) // block_size for s in self.shards], dtype=np.int64)
+        self.cum_chunks = np.cumsum(chunks)
+        self.first_chunk = self.cum_chunks - chunks
+        self.num_chunks = int(self.cum_chunks[-1])
+        self._open = OrderedDict() # shard index -> np.memmap
+        # the prefetch thread and the main thread (eval batches) share the table
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_single_file(cls, path, block_size, dtype=np.uint16):
+        num_tokens = os.path.getsize(path) // np.dtype(dtype).itemsize
+        shard = {'name': os.path.basename(path), 'num_tokens': num_tokens, 'offset': 0}
+        return cls(os.path.dirname(path), [shard], block_size, dtype)
+
+    def memmap(self, i):
+        with self._lock:
+            data = self._open.get(i)
+            if data is None:
+                # every memmap holds a file descriptor, so cap how many stay open at once
+                if len(self._open) >= self.max_open:
+                    self._open.popitem(last=False)
+                data = np.memmap(os.path.join(self.split_dir, self.shards[i]['name']), dtype=self.dtype, mode='r')
+                self._open[i] = data
+            else:
+                self._open.move_to_end(i)
+            return data
+
+    def locate(self, positions):
+        """ Map global window indices in [0, num_windows) to (shard index, start offset) arrays. """
+        shard_ix = np.searchsorted(self.cum_starts, positions, side='right')
+        return shard_ix, positions - self.first_window[shard_ix]
+
+    def sample(self, batch_size, out=None):
+        """
+        Gather batch_size random windows of block_size+1 tokens into an int64 tensor of shape
+        (batch_size, block_size+1), written into out if given.
+        """
+        positions = torch.randint(self.num_windows, (batch_size,)).numpy()
+        return self.gather(*self.locate(positions), out)
+
+    def read(self, chunks, out=None):
+        """ Like sample, but gathers the given non-overlapping windows (indices in [0, num_chunks)). """
+        shard_ix = np.searchsorted(self.cum_chunks, chunks, side='right')
+        return self.gather(shard_ix, (chunks - self.first_chunk[shard_ix]) * self.block_size, out)
+
+    def spread(self, n):
+        """ Indices of n non-overlapping windows spread evenly over the split, for a fixed eval set. """
+        return np.linspace(0, self.num_chunks - 1, n).round().astype(np.int64)
+
+    def gather(self, shard_ix, starts, out=None):
+        # rows from the same shard are gathered with one fancy index over its memmap,
+        # so there is no per-row Python slicing
+        if out is None:
+            out = torch.empty((len(starts), self.block_size + 1), dtype=torch.int64)
+        buf = out.numpy()
+        window = np.arange(self.block_size + 1, dtype=np.int64)
+        for i in np.unique(shard_ix):
+            rows = np.nonzero(shard_ix == i)[0]
+            buf[rows] = self.memmap(i)[starts[rows, None] + window]
+        return out
+
+    def get_batch(self, batch_size):
+        """ Sample a batch of (x, y) int64 tensors, y being x shifted by one token. """
+        return split_xy(self.sample(batch_size))
+
+def split_xy(tokens):
+    # x and y are overlapping views of the same (B, block_size+1) buffer
+    return tokens[:, :-1], tokens[:, 1:]
+
+class EpochSampler:
+    """
+    Deterministic order of the non-overlapping windows of a dataset for training. Every epoch is
+    a seeded permutation of all num_chunks windows, and the global stream of permuted windows is
+    dealt out in turn to the ranks: batch `step` of rank r is the batch_size windows starting at
+    (step * world_size + r) * batch_size. So ranks never read the same window within an epoch, the
+    order does not depend on how far ahead a prefetcher runs, and a run resumes exactly by
+    restarting at the saved step. The permutation is a keyed Feistel network over the next power of
+    four with cycle walking, which costs no memory however many windows there are.
+    """
+
+    rounds = 4
+
+    def __init__(self, num_chunks, batch_size, seed=1337, rank=0, world_size=1):
+        self.num_chunks = num_chunks
+        self.batch_size = batch_size
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.half_bits = max((int(num_chunks - 1).bit_length() + 1) // 2, 1)
+        self.mask = np.uint64((1 << self.half_bits) - 1)
+
+    def epoch_keys(self, epoch):
+        return np.random.default_rng([self.seed, epoch]).integers(2**63, size=self.rounds, dtype=np.uint64)
+
+    def _feistel(self, x, keys):
+        half = np.uint64(self.half_bits)
+        left, right = x >> half, x & self.mask
+        for key in keys:
+            # splitmix64-style mixing of the right half with the round key
+            h = (right ^ key) * np.uint64(0x9E3779B97F4A7C15)
+            h ^= h >> np.uint64(31)
+            h *= np.uint64(0xBF58476D1CE4E5B9)
+            h ^= h >> np.uint64(29)
+            left, right = right, left ^ (h & self.mask)
+        return (left << half) | right
+
+    def permute(self, index, epoch):
+        """ Position of window `index` in the order of `epoch`, a bijection on [0, num_chunks). """
+        keys = self.epoch_keys(epoch)
+        x = self._feistel(index.astype(np.uint64), keys)
+        # values past num_chunks are walked along their cycle until they land back inside,
+        # the domain is less than 4x num_chunks so this takes few iterations
+        out = x >= self.num_chunks
+        while out.any():
+            x[out] = self._feistel(x[out], keys)
+            out[out] = x[out] >= self.num_chunks
+        return x.astype(np.int64)
+
+    def indices(self, step):
+        """ The windows of batch `step` of this rank. """
+        first = (step * self.world_size + self.rank) * self.batch_size
+        positions = first + np.arange(self.batch_size, dtype=np.int64)
+        epochs, index = np.divmod(positions, self.num_chunks)
+        chunks = np.empty(self.batch_size, dtype=np.int64)
+        for epoch in np.unique(epochs):
+            rows = epochs == epoch
+            chunks[rows] = self.permute(index[rows], int(epoch))
+        return chunks
+
+    def windows_seen(self, step):
+        """ Windows handed out over all ranks before batch `step`, the resumable data position. """
+        return step * self.world_size * self.batch_size
+
+    def step_at(self, windows_seen):
+        """ Batch step of this rank to resume at, also valid after changing batch_size or world_size. """
+        return windows_seen // (self.world_size * self.batch_size)
+
+class BatchPrefetcher:
+    """
+    Fills a bounded queue of ready (x, y) batches on a background thread so that indexing the
+    memmaps and copying tokens happen while the model is busy. Batches are written into a ring
+    of preallocated (pinned, on cuda) (B, block_size+1) host buffers that get reused instead of
+    allocating new tensors for every batch, and x/y are views into them. A slot is only refilled once the consumer is done with it: on cuda
+    when its host-to-device copy has finished, on cpu (where the returned tensors *are* the
+    buffers) once `hold` newer batches have been handed out. The training loop keeps two
+    batches alive at a time (the one being backpropagated and the next one), hence hold=2.
+    """
+
+    def __init__(self, dataset, batch_size, device, depth=4, hold=2, sampler=None, step=0):
+        self.device = device
+        self.cuda = 'cuda' in str(device)
+        self.hold = hold
+        num_slots = depth + hold + 1
+        shape = (batch_size, dataset.block_size + 1)
+        self.buffers = [torch.empty(shape, dtype=torch.int64, pin_memory=self.cuda) for _ in range(num_slots)]
+        self.copied = [torch.cuda.Event() if self.cuda else None for _ in range(num_slots)]
+        self.free = queue.Queue()
+        self.ready = queue.Queue(maxsize=depth)
+        self.held = deque()
+        for slot in range(num_slots):
+            self.free.put(slot)
+        # queue-depth / stall-time counters, reset by stats()
+        self.num_batches = 0
+        self.depth_sum = 0
+        self.stall_time = 0.0
+        self.thread = threading.Thread(target=self._worker, args=(dataset, batch_size, sampler, step), daemon=True)
+        self.thread.start()
+
+    def _worker(self, dataset, batch_size, sampler, step):
+        try:
+            while True:
+                slot = self.free.get()
+                if slot is None:
+                    return
+                if self.copied[slot] is not None:
+                    self.copied[slot].synchronize() # previous contents must have reached the gpu
+                if sampler is not None:
+                    # batches come out in step order, so the consumer can count its position
+                    dataset.read(sampler.indices(step), out=self.buffers[slot])
+                    step += 1
+                else:
+                    dataset.sample(batch_size, out=self.buffers[slot])
+                self.ready.put(slot)
+        except Exception as e:
+            self.ready.put(e) # re-raised in the consumer
+
+    def next(self):
+        self.depth_sum += self.ready.qsize()
+        t0 = time.time()
+        slot = self.ready.get()
+        self.stall_time += time.time() - t0
+        if isinstance(slot, Exception):
+            raise slot
+        self.num_batches += 1
+        tokens = self.buffers[slot]
+        if self.cuda:
+            # a single copy of the whole window buffer, x and y are then sliced on the device
+            tokens = tokens.to(self.device, non_blocking=True)
+            self.copied[slot].record()
+        # hand back the slot of the oldest batch the consumer can no longer be using
+        self.held.append(slot)
+        if len(self.held) > self.hold:
+            self.free.put(self.held.popleft())
+        return split_xy(tokens)
+
+    def stats(self):
+        """ Mean ready-queue depth and mean time spent waiting on data per batch since the last call. """
+        n = max(self.num_batches, 1)
+        out = {'queue_depth': self.depth_sum / n, 'stall_time': self.stall_time / n}
+        self.num_batches, self.depth_sum, self.stall_time = 0, 0, 0.0
+        return out
+
+    def close(self):
+        self.free.put(None)
@@ -0,0 +1,41 @@
+"""
+Export an inference-only artifact from a training checkpoint, for prompt.py (init_from='export').
+The artifact holds only the model weights in the chosen dtype, the model args and the tokenizer path,
+so it is a fraction of the size of ckpt.pt (whose AdamW state alone is twice the model) and can be
+memory-mapped on load.
+
+$ python export.py --out_dir=bpe-simplewiki-out --dtype=bfloat16
+"""
+import os
+import time
+import pickle
+import torch
+from checkpoint import export_model
+
+# -----------------------------------------------------------------------------
+out_dir = 'bpe-simplewiki-out' # directory with the ckpt.pt to export
+export_path = '' # defaults to model.pt in out_dir
+meta_pkl_path = './data/prepare-out/meta.pkl'
+dtype = 'bfloat16' # 'float32' or 'bfloat16' or 'float16', dtype of the exported weights
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+ckpt_path = os.path.join(out_dir, 'ckpt.pt')
+export_path = export_path or os.path.join(out_dir, 'model.pt')
+ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
+
+# the data scripts write tokenizer.json next to meta.pkl, store its absolute path in the artifact
+tokenizer_path = None
+if os.path.exists(meta_pkl_path):
+    with open(meta_pkl_path, 'rb') as f:
+        meta = pickle.load(f)
+    tokenizer_path = os.path.abspath(os.path.join(os.path.dirname(meta_pkl_path), os.path.basename(meta['tokenizer'])))
+else:
+    print(f"no meta at {meta_pkl_path}, exporting without a tokenizer path")
+
+t0 = time.time()
+checkpoint = torch.load(ckpt_path, map_location='cpu', mmap=True, weights_only=False)
+artifact = export_model(checkpoint, export_path, dtype=ptdtype, tokenizer=tokenizer_path)
+print(f"exported {ckpt_path} ({os.path.getsize(ckpt_path)/1e6:.1f}MB) to {export_path} "
+      f"({os.path.getsize(export_path)/1e6:.1f}MB, {dtype}) in {time.time()-t0:.2f}s")
+print(f"tokenizer: {artifact['tokenizer']}")
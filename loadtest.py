@@ -0,0 +1,89 @@
+"""
+Synthetic load client for serve.py. Sends num_requests streaming generation requests with random
+word prompts, optionally behind a shared preamble, arriving as a poisson process at `rate`
+requests/s (0 for all at once) with at most `concurrency` in flight, and reports client-side
+latencies and throughput next to the server's own /metrics.
+$ python serve.py --device=cpu &
+$ python loadtest.py --num_requests=64 --concurrency=16
+"""
+import json
+import time
+import random
+import threading
+import urllib.request
+
+# -----------------------------------------------------------------------------
+url = 'http://127.0.0.1:8000'
+num_requests = 32
+concurrency = 8 # requests in flight at most
+rate = 0.0 # mean arrivals per second, 0 to send as fast as concurrency allows
+prompt_words = 20 # prompts have between 1 and 2x this many words
+shared_prefix_words = 0 # words of a preamble that every prompt starts with, like a system prompt or few-shot template
+max_new_tokens = 64 # requests ask for between 1 and 2x this many tokens
+temperature = 0.8
+seed = 1337
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+WORDS = ['the', 'city', 'river', 'was', 'founded', 'in', 'and', 'population', 'of', 'is', 'a', 'known',
+         'for', 'its', 'church', 'school', 'century', 'north', 'people', 'music', 'film', 'born', 'world']
+
+def generate(prompt, new_tokens):
+    """ One streaming request, returns (ttft, e2e, tokens received, server summary). """
+    body = json.dumps({'prompt': prompt, 'max_new_tokens': new_tokens, 'temperature': temperature, 'stream': True})
+    t0 = time.perf_counter()
+    ttft, tokens, summary = None, 0, {}
+    with urllib.request.urlopen(urllib.request.Request(url + '/generate', data=body.encode('utf-8'))) as response:
+        for line in response:
+            event = json.loads(line)
+            if event.get('done'):
+                summary = event
+                break
+            if ttft is None:
+                ttft = time.perf_counter() - t0
+            tokens += 1
+    return ttft, time.perf_counter() - t0, tokens, summary
+
+def percentiles(values):
+    if not values:
+        return 'n/a'
+    values = sorted(values)
+    return ' '.join(f"p{p} {values[min(len(values) * p // 100, len(values) - 1)] * 1000:.0f}ms" for p in (50, 90, 99))
+
+if __name__ == "__main__":
+    rng = random.Random(seed)
+    preamble = ''.join(rng.choice(WORDS) + ' ' for _ in range(shared_prefix_words))
+    jobs = [(preamble + ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 2 * prompt_words))), rng.randint(1, 2 * max_new_tokens))
+            for _ in range(num_requests)]
+    results, errors = [], []
+    slots = threading.Semaphore(concurrency)
+    def worker(prompt, new_tokens):
+        try:
+            results.append(generate(prompt, new_tokens))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            slots.release()
+
+    t0 = time.perf_counter()
+    threads = []
+    for prompt, new_tokens in jobs:
+        if rate > 0:
+            time.sleep(rng.expovariate(rate))
+        slots.acquire()
+        threads.append(threading.Thread(target=worker, args=(prompt, new_tokens)))
+        threads[-1].start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - t0
+
+    tokens = sum(r[2] for r in results)
+    print(f"{len(results)} requests ({len(errors)} failed) in {elapsed:.1f}s: {len(results) / elapsed:.2f} requests/s, {tokens / elapsed:.1f} tokens/s")
+    if results:
+        print(f"time to first token: {percentiles([r[0] for r in results if r[0] is not None])}")
+        print(f"time per output token: {percentiles([(r[1] - r[0]) / (r[2] - 1) for r in results if r[2] > 1])}")
+        print(f"end to end: {percentiles([r[1] for r in results])}")
+    if errors:
+        print(f"first error: {errors[0]!r}")
+    with urllib.request.urlopen(url + '/metrics') as response:
+        print(f"server metrics: {json.dumps(json.load(response), indent=2)}")
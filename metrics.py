@@ -0,0 +1,216 @@
+"""
+Training instrumentation for train.py: per-phase step timers, peak memory counters, optional
+torch.profiler capture windows, and a metrics logger that writes every record to a local JSONL or
+CSV file in out_dir (works offline) and, optionally, to wandb.
+"""
+
+import os
+import re
+import csv
+import json
+import time
+import resource
+from collections import defaultdict
+from contextlib import contextmanager
+
+import torch
+
+class PhaseTimer:
+    """
+    Accumulates wall-clock time per named phase of the training step (data, forward, backward, ...).
+    cuda kernels run asynchronously, so with sync=True the device is synchronized at the end of every
+    phase and its time is charged to the phase that launched it. That costs a little throughput,
+    without it most of the gpu time shows up wherever the next sync happens to be. Phases are also
+    labelled with record_function, so they show up by name in profiler traces.
+    """
+
+    def __init__(self, sync=False):
+        self.sync = sync and torch.cuda.is_available()
+        self.totals = defaultdict(float)
+        self.num_iters = 0
+
+    @contextmanager
+    def __call__(self, phase):
+        t0 = time.perf_counter()
+        with torch.profiler.record_function(phase):
+            yield
+        if self.sync:
+            torch.cuda.synchronize()
+        self.totals[phase] += time.perf_counter() - t0
+
+    def step(self):
+        self.num_iters += 1
+
+    def stats(self):
+        """ Mean ms per iteration of every phase since the last call, by phase name. """
+        n = max(self.num_iters, 1)
+        out = {phase: total / n * 1000 for phase, total in self.totals.items()}
+        self.totals.clear()
+        self.num_iters = 0
+        return out
+
+def peak_memory(device_type):
+    """ Peak memory since the last call on cuda (allocated by tensors and reserved by the caching allocator), peak RSS of the process on cpu. """
+    if device_type == 'cuda':
+        out = {
+            'mem/peak_allocated_mb': torch.cuda.max_memory_allocated() / 2**20,
+            'mem/peak_reserved_mb': torch.cuda.max_memory_reserved() / 2**20,
+        }
+        torch.cuda.reset_peak_memory_stats()
+        return out
+    return {'mem/peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024} # KB on linux
+
+# dense (no sparsity) peak tensor core flops per dtype of common gpus.
+# 16-bit figures are with fp32 accumulation, which is what bf16/fp16 matmuls use. 'float32' is the
+# plain fp32 peak; with allow_tf32 float32 matmuls run on the 'tfloat32' tensor cores (Ampere and
+# newer, older cards have no 'tfloat32' entry and lookup_peak_flops falls back to 'float32').
+# Keys are regexes searched in the device name in order, the first match wins: more specific
+# names come first, and word boundaries keep 'L4' from matching an L40 (the H100 SXM reports
+# itself as e.g. "NVIDIA H100 80GB HBM3", so plain 'H100' is the SXM entry)
+PEAK_FLOPS = {
+    r'\bH100 PCIe\b': {'bfloat16': 756e12, 'float16': 756e12, 'float32': 51e12, 'tfloat32': 378e12},
+    r'\bH100 NVL\b': {'bfloat16': 835e12, 'float16': 835e12, 'float32': 60e12, 'tfloat32': 417.5e12},
+    r'\bH100\b': {'bfloat16': 989e12, 'float16': 989e12, 'float32': 67e12, 'tfloat32': 494.5e12},
+    r'\bA100\b': {'bfloat16': 312e12, 'float16': 312e12, 'float32': 19.5e12, 'tfloat32': 156e12},
+    r'\bA10G\b': {'bfloat16': 70e12, 'float16': 70e12, 'float32': 31.2e12, 'tfloat32': 35e12},
+    r'\bA10\b': {'bfloat16': 125e12, 'float16': 125e12, 'float32': 31.2e12, 'tfloat32': 62.5e12},
+    r'\bL40S\b': {'bfloat16': 362e12, 'float16': 362e12, 'float32': 91.6e12, 'tfloat32': 183e12},
+    r'\bL40\b': {'bfloat16': 181e12, 'float16': 181e12, 'float32': 90.5e12, 'tfloat32': 90.5e12},
+    r'\bL4\b': {'bfloat16': 121e12, 'float16': 121e12, 'float32': 30.3e12, 'tfloat32': 60e12},
+    r'\bV100\b': {'float16': 125e12, 'float32': 15.7e12},
+    r'\bT4\b': {'float16': 65e12, 'float32': 8.1e12},
+    r'\bRTX 4090\b': {'bfloat16': 165e12, 'float16': 165e12, 'float32': 82.6e12, 'tfloat32': 82.6e12},
+    r'\bRTX 3090 Ti\b': {'bfloat16': 80e12, 'float16': 80e12, 'float32': 40e12, 'tfloat32': 40e12},
+    r'\bRTX 3090\b': {'bfloat16': 71e12, 'float16': 71e12, 'float32': 35.6e12, 'tfloat32': 35.6e12},
+    r'\bRTX 3060 Ti\b': {'bfloat16': 32.4e12, 'float16': 32.4e12, 'float32': 16.2e12, 'tfloat32': 16.2e12},
+}
+
+def lookup_peak_flops(device, dtype):
+    """ Peak flops of a known cuda device for dtype ('bfloat16', 'tfloat32', ...), None if not in PEAK_FLOPS. """
+    if 'cuda' not in str(device):
+        return None
+    name = torch.cuda.get_device_name(device)
+    for pattern, peaks in PEAK_FLOPS.items():
+        if re.search(pattern, name):
+            return peaks.get(dtype, peaks.get('float32') if dtype == 'tfloat32' else None)
+    return None
+
+def measure_peak_flops(device, dtype, size=None, seconds=0.5):
+    """
+    Flops of a square matmul on device in dtype, a short benchmark that stands in for the peak of
+    devices missing from PEAK_FLOPS. It measures what is achievable rather than the datasheet number,
+    so mfu against it reads somewhat higher.
+    """
+    ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
+    size = size or (8192 if 'cuda' in str(device) else 1024)
+    a = torch.randn(size, size, device=device, dtype=ptdtype)
+    b = torch.randn(size, size, device=device, dtype=ptdtype)
+    sync = torch.cuda.synchronize if 'cuda' in str(device) else (lambda: None)
+    a @ b # warmup
+    sync()
+    iters, t0 = 0, time.perf_counter()
+    while time.perf_counter() - t0 < seconds:
+        a @ b
+        iters += 1
+        if iters % 10 == 0 or 'cuda' not in str(device):
+            sync()
+    sync()
+    return 2 * size**3 * iters / (time.perf_counter() - t0)
+
+class ProfilerWindows:
+    """
+    Captures a torch.profiler trace of `steps` iterations starting at iteration `start`, and again
+    every `every` iterations after that if every > 0 (a negative start disables profiling).
+    Each window is written to out_dir/profile-<start>.json (open in chrome://tracing or perfetto)
+    and its top operators are printed.
+    """
+
+    def __init__(self, start, steps, out_dir, device_type, every=0):
+        self.first = start
+        self.every = every
+        self.steps = steps
+        self.out_dir = out_dir
+        self.activities = [torch.profiler.ProfilerActivity.CPU]
+        if device_type == 'cuda':
+            self.activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = None
+
+    def begin(self, iter_num):
+        if self.profiler is None and self.starts_at(iter_num):
+            self.start, self.stop = iter_num, iter_num + self.steps
+            self.profiler = torch.profiler.profile(activities=self.activities, profile_memory=True)
+            self.profiler.__enter__()
+
+    def starts_at(self, iter_num):
+        if self.first < 0 or iter_num < self.first:
+            return False
+        return iter_num == self.first or (self.every > 0 and (iter_num - self.first) % self.every == 0)
+
+    def end(self, iter_num):
+        if self.profiler is not None and iter_num + 1 >= self.stop:
+            self.profiler.__exit__(None, None, None)
+            path = os.path.join(self.out_dir, f"profile-{self.start}.json")
+            self.profiler.export_chrome_trace(path)
+            sort_by = 'cuda_time_total' if len(self.activities) > 1 else 'cpu_time_total'
+            print(self.profiler.key_averages().table(sort_by=sort_by, row_limit=15))
+            print(f"profiled iterations {self.start}-{self.stop - 1}, trace written to {path}")
+            self.profiler = None
+
+class JSONLSink:
+    """ One JSON object per record. """
+
+    def __init__(self, path):
+        self.file = open(path, 'a')
+
+    def log(self, metrics):
+        self.file.write(json.dumps(metrics) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class CSVSink:
+    """ Long format (time, iter, key, value) rows, so records with different keys share one file. """
+
+    def __init__(self, path):
+        new = not os.path.exists(path)
+        self.file = open(path, 'a', newline='')
+        self.writer = csv.writer(self.file)
+        if new:
+            self.writer.writerow(['time', 'iter', 'key', 'value'])
+
+    def log(self, metrics):
+        t, it = metrics['time'], metrics['iter']
+        self.writer.writerows([t, it, k, v] for k, v in metrics.items() if k not in ('time', 'iter'))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class WandbSink:
+
+    def __init__(self, project, name, config):
+        import wandb
+        self.wandb = wandb
+        wandb.init(project=project, name=name, config=config)
+
+    def log(self, metrics):
+        self.wandb.log({k: v for k, v in metrics.items() if k != 'time'})
+
+    def close(self):
+        self.wandb.finish()
+
+class MetricsLogger:
+    """ Sends every record, stamped with the iteration and the wall-clock time, to all sinks. """
+
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def log(self, metrics, iter_num):
+        record = {'time': time.time(), 'iter': iter_num, **metrics}
+        for sink in self.sinks:
+            sink.log(record)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
@@ -10,10 +10,12 @@ https://github.com/huggingface/transformers/blob/main/src/transformers/models/gp
 import math
 import inspect
 from dataclasses import dataclass
+from collections import OrderedDict
 
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 
 # @torch.jit.script # good to enable when not using torch.compile, disable when using (our default)
 def new_gelu(x):
@@ -34,10 +36,189 @@ class LayerNorm(nn.Module):
     def forward(self, input):
         return F.layer_norm(input, self.weight.shape, self.weight, self.bias, 1e-5)
 
+class KVCache:
+    """
+    Preallocated per-layer keys and values for incremental decoding. Each layer writes the
+    keys/values of the new positions into its slot and attends over everything cached so far,
+    so a decode step only has to forward the newest token instead of the whole sequence.
+    """
+
+    def __init__(self, n_layer, max_len):
+        self.max_len = max_len
+        self.k = [None] * n_layer # (B, nh, max_len, hs) per layer, allocated lazily on first write
+        self.v = [None] * n_layer
+        self.seq_len = 0 # number of positions already cached
+
+    def update(self, layer_idx, k, v):
+        # write the new keys/values at [seq_len, seq_len+T) and return views over all cached positions
+        B, nh, T, hs = k.size()
+        if self.k[layer_idx] is None:
+            self.k[layer_idx] = k.new_empty(B, nh, self.max_len, hs)
+            self.v[layer_idx] = v.new_empty(B, nh, self.max_len, hs)
+        end = self.seq_len + T
+        assert end <= self.max_len, f"KV cache overflow: {end} > {self.max_len}"
+        self.k[layer_idx][:, :, self.seq_len:end] = k
+        self.v[layer_idx][:, :, self.seq_len:end] = v
+        return self.k[layer_idx][:, :, :end], self.v[layer_idx][:, :, :end]
+
+    def crop(self, seq_len):
+        # forget every position from seq_len on, they get overwritten by the next update
+        self.seq_len = min(self.seq_len, seq_len)
+
+    def advance(self, T):
+        self.seq_len += T
+
+    def read_prefix(self, end, row=0):
+        # copy of the keys/values of positions [0, end) of one row, (n_layer, 2, nh, end, hs)
+        return torch.stack([torch.stack((k[row, :, :end], v[row, :, :end])) for k, v in zip(self.k, self.v)])
+
+    def load_prefix(self, kv, batch_size):
+        # start every row from the keys/values kv of a prompt prefix, as returned by read_prefix
+        _, _, nh, T, hs = kv.size()
+        for layer_idx in range(len(self.k)):
+            if self.k[layer_idx] is None:
+                self.k[layer_idx] = kv.new_empty(batch_size, nh, self.max_len, hs)
+                self.v[layer_idx] = kv.new_empty(batch_size, nh, self.max_len, hs)
+            self.k[layer_idx][:, :, :T] = kv[layer_idx, 0]
+            self.v[layer_idx][:, :, :T] = kv[layer_idx, 1]
+        self.seq_len = T
+
+class SlotKVCache:
+    """
+    KV cache of num_slots independent sequences of different lengths, for continuous batching:
+    a sequence takes a free slot when it arrives and gives it back when it finishes, while the
+    others keep decoding. A forward covers the slots picked with select(), one row of idx per
+    slot and the same number of new tokens in every row, and each row continues at its own
+    length. Attention is masked per row, so a slot never sees the stale keys of its previous user.
+    """
+
+    def __init__(self, n_layer, num_slots, max_len):
+        self.max_len = max_len
+        self.k = [None] * n_layer # (num_slots, nh, max_len, hs) per layer, allocated lazily on first write
+        self.v = [None] * n_layer
+        self.lengths = [0] * num_slots # cached positions of every slot, kept on the host
+        self.rows = list(range(num_slots))
+
+    def select(self, rows):
+        # the slots the next forward is for, in the order of the rows of idx
+        self.rows = list(rows)
+        return self
+
+    def positions(self, T, device):
+        # absolute positions of the new tokens, (B, T)
+        starts = [self.lengths[slot] for slot in self.rows]
+        assert max(starts) + T <= self.max_len, f"KV cache overflow: {max(starts) + T} > {self.max_len}"
+        self.span = max(starts) + T # cached positions any row attends to in this forward
+        self.pos = torch.tensor(starts, device=device).unsqueeze(1) + torch.arange(T, device=device)
+        return self.pos
+
+    def update(self, layer_idx, k, v):
+        # write the new keys/values of every row at its own positions, return the cached keys/values
+        # of the selected slots and the (B, 1, T, S) mask of the positions each query may attend to
+        B, nh, T, hs = k.size()
+        if self.k[layer_idx] is None:
+            self.k[layer_idx] = k.new_zeros(len(self.lengths), nh, self.max_len, hs)
+            self.v[layer_idx] = v.new_zeros(len(self.lengths), nh, self.max_len, hs)
+        rows = torch.tensor(self.rows, device=k.device)
+        self.k[layer_idx][rows.unsqueeze(1), :, self.pos] = k.transpose(1, 2)
+        self.v[layer_idx][rows.unsqueeze(1), :, self.pos] = v.transpose(1, 2)
+        keys = self.k[layer_idx][rows, :, :self.span]
+        values = self.v[layer_idx][rows, :, :self.span]
+        mask = torch.arange(self.span, device=k.device) <= self.pos.unsqueeze(-1) # (B, T, S)
+        return keys, values, mask.unsqueeze(1)
+
+    def advance(self, T):
+        for slot in self.rows:
+            self.lengths[slot] += T
+
+    def free(self, slot):
+        self.lengths[slot] = 0
+
+    def read_prefix(self, end, slot):
+        # copy of the keys/values of positions [0, end) of one slot, (n_layer, 2, nh, end, hs)
+        return torch.stack([torch.stack((k[slot, :, :end], v[slot, :, :end])) for k, v in zip(self.k, self.v)])
+
+    def load_prefix(self, kv, slot):
+        # start the slot from the keys/values kv of a prompt prefix, as returned by read_prefix
+        _, _, nh, T, hs = kv.size()
+        for layer_idx in range(len(self.k)):
+            if self.k[layer_idx] is None:
+                self.k[layer_idx] = kv.new_zeros(len(self.lengths), nh, self.max_len, hs)
+                self.v[layer_idx] = kv.new_zeros(len(self.lengths), nh, self.max_len, hs)
+            self.k[layer_idx][slot, :, :T] = kv[layer_idx, 0]
+            self.v[layer_idx][slot, :, :T] = kv[layer_idx, 1]
+        self.lengths[slot] = T
+
+class PrefixCache:
+    """
+    LRU cache of the keys/values of prompt prefixes, shared between generate calls (or server
+    requests), so prompts that start with the same preamble only forward their unseen suffix.
+    Keys/values are stored per chunk_size tokens, each chunk keyed by the whole token prefix it
+    ends, which makes matches exact and lets prompts share the chunks of their common prefix.
+    Past max_bytes the least recently used chunks are evicted, longer prefixes before the
+    shorter ones they extend. Positions are absolute (learned wpe), so only prefixes that start
+    the prompt can be reused.
+    """
+
+    def __init__(self, max_bytes, chunk_size=16):
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.entries = OrderedDict() # token prefix tuple -> (n_layer, 2, nh, chunk_size, hs), least recently used first
+        self.num_bytes = 0
+        self.counters = {'lookups': 0, 'hits': 0, 'lookup_tokens': 0, 'saved_prefill_tokens': 0, 'evictions': 0}
+
+    def lookup(self, ids, max_len=None):
+        """ Longest cached prefix of the token list ids of at most max_len tokens, as (length, keys/values or None). """
+        max_len = len(ids) if max_len is None else min(max_len, len(ids))
+        keys = []
+        for end in range(self.chunk_size, max_len + 1, self.chunk_size):
+            key = tuple(ids[:end])
+            if key not in self.entries:
+                break
+            keys.append(key)
+        self._touch(keys)
+        n = len(keys) * self.chunk_size
+        self.counters['lookups'] += 1
+        self.counters['hits'] += n > 0
+        self.counters['lookup_tokens'] += len(ids)
+        self.counters['saved_prefill_tokens'] += n
+        return n, torch.cat([self.entries[key] for key in keys], dim=3) if keys else None
+
+    def insert(self, ids, kv):
+        """ Cache the whole chunks of the token list ids, kv holds the keys/values of its positions as from read_prefix. """
+        keys = []
+        for end in range(self.chunk_size, len(ids) + 1, self.chunk_size):
+            key = tuple(ids[:end])
+            if key not in self.entries:
+                # clone, a view would keep all of kv alive
+                self.entries[key] = kv[:, :, :, end - self.chunk_size:end].clone()
+                self.num_bytes += self.entries[key].nbytes
+            keys.append(key)
+        self._touch(keys)
+        while self.num_bytes > self.max_bytes and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.num_bytes -= evicted.nbytes
+            self.counters['evictions'] += 1
+
+    def _touch(self, keys):
+        # mark as most recently used, the shortest prefix last so it is evicted after its extensions
+        for key in reversed(keys):
+            self.entries.move_to_end(key)
+
+    def stats(self):
+        return {
+            **self.counters,
+            'hit_rate': self.counters['hits'] / max(self.counters['lookups'], 1),
+            'saved_prefill_fraction': self.counters['saved_prefill_tokens'] / max(self.counters['lookup_tokens'], 1),
+            'entries': len(self.entries),
+            'mb': self.num_bytes / 2**20,
+        }
+
 class CausalSelfAttention(nn.Module):
 
-    def __init__(self, config):
+    def __init__(self, config, layer_idx=0):
         super().__init__()
+        self.layer_idx = layer_idx
         assert config.n_embd % config.n_head == 0
         # key, query, value projections for all heads, but in a batch
         self.c_attn = nn.Linear(config.n_embd, 3 * config.n_embd, bias=config.bias)
@@ -57,7 +238,7 @@ class CausalSelfAttention(nn.Module):
             self.register_buffer("bias", torch.tril(torch.ones(config.block_size, config.block_size))
                                         .view(1, 1, config.block_size, config.block_size))
 
-    def forward(self, x):
+    def forward(self, x, kv_cache=None):
         B, T, C = x.size() # batch size, sequence length, embedding dimensionality (n_embd)
 
         # calculate query, key, values for all heads in batch and move head forward to be the batch dim
@@ -66,6 +247,27 @@ class CausalSelfAttention(nn.Module):
         q = q.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
         v = v.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
 
+        if isinstance(kv_cache, SlotKVCache):
+            # continuous batching: every row continues its own sequence, masked to its own length
+            k, v, mask = kv_cache.update(self.layer_idx, k, v) # (B, nh, S, hs)
+            y = self._masked_attention(q, k, v, mask)
+        elif kv_cache is not None and kv_cache.seq_len > 0:
+            # incremental decoding: attend over the cached positions plus the new ones
+            past = kv_cache.seq_len
+            k, v = kv_cache.update(self.layer_idx, k, v) # (B, nh, past+T, hs)
+            y = self._cached_attention(q, k, v, past)
+        else:
+            if kv_cache is not None:
+                # prefill: plain causal attention, just remember the keys/values for later steps
+                kv_cache.update(self.layer_idx, k, v)
+            y = self._causal_attention(q, k, v, T)
+        y = y.transpose(1, 2).contiguous().view(B, T, C) # re-assemble all head outputs side by side
+
+        # output projection
+        y = self.resid_dropout(self.c_proj(y))
+        return y
+
+    def _causal_attention(self, q, k, v, T):
         # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, T) -> (B, nh, T, T)
         if self.flash:
             # efficient attention using Flash Attention CUDA kernels
@@ -77,12 +279,31 @@ class CausalSelfAttention(nn.Module):
             att = F.softmax(att, dim=-1)
             att = self.attn_dropout(att)
             y = att @ v # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
-        y = y.transpose(1, 2).contiguous().view(B, T, C) # re-assemble all head outputs side by side
-
-        # output projection
-        y = self.resid_dropout(self.c_proj(y))
         return y
 
+    def _cached_attention(self, q, k, v, past):
+        # queries sit at positions [past, past+T) and may see every key up to and including their own
+        T, S = q.size(2), k.size(2)
+        if self.flash:
+            # a single query sees all cached keys, so no mask is needed at all
+            mask = None if T == 1 else torch.ones(T, S, dtype=torch.bool, device=q.device).tril(diagonal=past)
+            return torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=self.dropout)
+        att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
+        att = att.masked_fill(self.bias[:,:,past:past+T,:S] == 0, float('-inf'))
+        att = F.softmax(att, dim=-1)
+        att = self.attn_dropout(att)
+        return att @ v
+
+    def _masked_attention(self, q, k, v, mask):
+        # attention under an explicit boolean mask, True where a query may see a key
+        if self.flash:
+            return torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=self.dropout)
+        att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
+        att = att.masked_fill(~mask, float('-inf'))
+        att = F.softmax(att, dim=-1)
+        att = self.attn_dropout(att)
+        return att @ v
+
 class MLP(nn.Module):
 
     def __init__(self, config):
@@ -100,15 +321,15 @@ class MLP(nn.Module):
 
 class Block(nn.Module):
 
-    def __init__(self, config):
+    def __init__(self, config, layer_idx=0):
         super().__init__()
         self.ln_1 = LayerNorm(config.n_embd, bias=config.bias)
-        self.attn = CausalSelfAttention(config)
+        self.attn = CausalSelfAttention(config, layer_idx)
         self.ln_2 = LayerNorm(config.n_embd, bias=config.bias)
         self.mlp = MLP(config)
 
-    def forward(self, x):
-        x = x + self.attn(self.ln_1(x))
+    def forward(self, x, kv_cache=None):
+        x = x + self.attn(self.ln_1(x), kv_cache)
         x = x + self.mlp(self.ln_2(x))
         return x
 
@@ -121,6 +342,65 @@ class GPTConfig:
     n_embd: int = 768
     dropout: float = 0.0
     bias: bool = True # True: bias in Linears and LayerNorms, like GPT-2. False: a bit better and faster
+    activation_checkpointing: str = 'none' # blocks whose activations are recomputed in backward: 'none', 'all' or indices like '0 2 4'
+    loss_chunk_size: int = 0 # positions per chunk of the lm_head + cross-entropy when the logits aren't returned, 0 for no chunking
+
+def checkpointed_blocks(spec, n_layer):
+    """ Parse GPTConfig.activation_checkpointing into a set of block indices. """
+    if spec == 'none':
+        return set()
+    if spec == 'all':
+        return set(range(n_layer))
+    blocks = set(int(i) for i in spec.replace(',', ' ').split())
+    assert all(0 <= i < n_layer for i in blocks), f"activation_checkpointing {spec!r} names blocks outside 0..{n_layer-1}"
+    return blocks
+
+def chunked_cross_entropy(x, weight, targets, chunk_size):
+    """ Mean cross-entropy of x @ weight.T against targets (ignoring -1), chunk_size positions at a time, without gradients. """
+    loss = torch.zeros((), dtype=torch.float32, device=x.device)
+    for i in range(0, targets.size(0), chunk_size):
+        logits = F.linear(x[i:i+chunk_size], weight).float()
+        loss += F.cross_entropy(logits, targets[i:i+chunk_size], ignore_index=-1, reduction='sum')
+    return loss / (targets != -1).sum()
+
+class ChunkedCrossEntropy(torch.autograd.Function):
+    """
+    Mean cross-entropy of the logits x @ weight.T against targets (ignoring -1), computed chunk_size
+    positions at a time so that no more than one chunk of logits exists at once instead of the whole
+    (B*T, vocab_size) tensor and its gradient. The gradients w.r.t. x and weight are computed right
+    away in the forward pass, chunk by chunk, from softmax(logits) - onehot(targets), which costs the
+    same matmuls a regular backward would and leaves backward with just a scaling.
+    """
+
+    @staticmethod
+    def forward(ctx, x, weight, targets, chunk_size):
+        num_targets = (targets != -1).sum()
+        needs_grad = ctx.needs_input_grad[0] or ctx.needs_input_grad[1]
+        grad_x = torch.empty_like(x) if needs_grad else None
+        grad_weight = torch.zeros_like(weight) if needs_grad else None
+        loss = torch.zeros((), dtype=torch.float32, device=x.device)
+        for i in range(0, targets.size(0), chunk_size):
+            x_chunk, t_chunk = x[i:i+chunk_size], targets[i:i+chunk_size]
+            logits = F.linear(x_chunk, weight).float()
+            loss += F.cross_entropy(logits, t_chunk, ignore_index=-1, reduction='sum')
+            if needs_grad:
+                # gradient of the summed loss w.r.t. the logits, zero at ignored positions
+                grad_logits = torch.softmax(logits, dim=-1)
+                valid = t_chunk != -1
+                grad_logits[valid, t_chunk[valid]] -= 1.0
+                grad_logits[~valid] = 0.0
+                # under autocast these matmuls run in the autocast dtype like the lm_head itself
+                grad_x[i:i+chunk_size] = grad_logits @ weight
+                grad_weight += grad_logits.t() @ x_chunk
+        if needs_grad:
+            ctx.save_for_backward(grad_x, grad_weight, num_targets)
+        return loss / num_targets
+
+    @staticmethod
+    def backward(ctx, grad_loss):
+        grad_x, grad_weight, num_targets = ctx.saved_tensors
+        scale = grad_loss / num_targets
+        return grad_x * scale, grad_weight * scale, None, None
 
 class GPT(nn.Module):
 
@@ -134,10 +414,13 @@ class GPT(nn.Module):
             wte = nn.Embedding(config.vocab_size, config.n_embd),
             wpe = nn.Embedding(config.block_size, config.n_embd),
             drop = nn.Dropout(config.dropout),
-            h = nn.ModuleList([Block(config) for _ in range(config.n_layer)]),
+            h = nn.ModuleList([Block(config, i) for i in range(config.n_layer)]),
             ln_f = LayerNorm(config.n_embd, bias=config.bias),
         ))
         self.lm_head = nn.Linear(config.n_embd, config.vocab_size, bias=False)
+        # activation checkpointing: only the inputs of these blocks are kept for backward, their
+        # insides are recomputed, trading about one extra forward pass of them for memory
+        self.checkpointed = checkpointed_blocks(config.activation_checkpointing, config.n_layer)
         # with weight tying when using torch.compile() some warnings get generated:
         # "UserWarning: functional_call was passed multiple values for tied weights.
         # This behavior is deprecated and will be an error in future versions"
@@ -175,27 +458,45 @@ class GPT(nn.Module):
         elif isinstance(module, nn.Embedding):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
 
-    def forward(self, idx, targets=None):
+    def forward(self, idx, targets=None, kv_cache=None, return_logits=True, num_logits=1):
         device = idx.device
         b, t = idx.size()
-        assert t <= self.config.block_size, f"Cannot forward sequence of length {t}, block size is only {self.config.block_size}"
-        pos = torch.arange(0, t, dtype=torch.long, device=device).unsqueeze(0) # shape (1, t)
+        # with a KV cache, idx only holds the new tokens and continues the cached positions
+        if isinstance(kv_cache, SlotKVCache):
+            pos = kv_cache.positions(t, device) # shape (b, t), every row at its own offset
+        else:
+            past = kv_cache.seq_len if kv_cache is not None else 0
+            assert past + t <= self.config.block_size, f"Cannot forward sequence of length {past + t}, block size is only {self.config.block_size}"
+            pos = torch.arange(past, past + t, dtype=torch.long, device=device).unsqueeze(0) # shape (1, t)
 
         # forward the GPT model itself
         tok_emb = self.transformer.wte(idx) # token embeddings of shape (b, t, n_embd)
-        pos_emb = self.transformer.wpe(pos) # position embeddings of shape (1, t, n_embd)
+        pos_emb = self.transformer.wpe(pos) # position embeddings of shape (1 or b, t, n_embd)
         x = self.transformer.drop(tok_emb + pos_emb)
-        for block in self.transformer.h:
-            x = block(x)
+        for i, block in enumerate(self.transformer.h):
+            if i in self.checkpointed and kv_cache is None and torch.is_grad_enabled():
+                x = checkpoint(block, x, use_reentrant=False)
+            else:
+                x = block(x, kv_cache)
         x = self.transformer.ln_f(x)
-
-        if targets is not None:
+        if kv_cache is not None:
+            kv_cache.advance(t)
+
+        if targets is not None and not return_logits and self.config.loss_chunk_size > 0:
+            # the caller only needs the loss, compute it without materializing all the logits
+            logits = None
+            if torch.is_grad_enabled():
+                loss = ChunkedCrossEntropy.apply(x.reshape(-1, x.size(-1)), self.lm_head.weight, targets.reshape(-1), self.config.loss_chunk_size)
+            else:
+                # evaluation: ChunkedCrossEntropy would still compute the gradients in its forward
+                loss = chunked_cross_entropy(x.reshape(-1, x.size(-1)), self.lm_head.weight, targets.reshape(-1), self.config.loss_chunk_size)
+        elif targets is not None:
             # if we are given some desired targets also calculate the loss
             logits = self.lm_head(x)
-            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1), ignore_index=-1)
+            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.reshape(-1), ignore_index=-1)
         else:
-            # inference-time mini-optimization: only forward the lm_head on the very last position
-            logits = self.lm_head(x[:, [-1], :]) # note: using list [-1] to preserve the time dim
+            # inference-time mini-optimization: only forward the lm_head on the last num_logits positions
+            logits = self.lm_head(x[:, -num_logits:, :]) # slicing preserves the time dim
             loss = None
 
         return logits, loss
@@ -325,41 +626,170 @@ class GPT(nn.Module):
 
         return optimizer
 
-    def estimate_flops(self, fwdbwd_per_iter, dt):
-        """ estimate model bfloat16 flops """
-        # first estimate the number of flops we do per iteration.
-        # see PaLM paper Appendix B as ref: https://arxiv.org/abs/2204.02311
-        N = self.get_num_params()
+    def estimate_flops(self, fwdbwd_per_iter, dt, seq_len=None):
+        """ estimate the model flops per second achieved, given the sequence length actually trained on """
+        # first estimate the number of flops we do per iteration, counting every matmul:
+        # per token and layer the qkv, output and mlp projections are 2*C*(3C + C + 8C) flops and the
+        # attention scores and weighted sum 2*2*T*C (the full T x T matrix, as in the PaLM paper
+        # Appendix B: https://arxiv.org/abs/2204.02311), plus the lm_head at 2*C*V per token.
+        # the backward pass costs twice the forward pass
         cfg = self.config
-        L, H, Q, T = cfg.n_layer, cfg.n_head, cfg.n_embd//cfg.n_head, cfg.block_size
-        flops_per_token = 6*N + 12*L*H*Q*T
+        L, C, V = cfg.n_layer, cfg.n_embd, cfg.vocab_size
+        T = cfg.block_size if seq_len is None else seq_len
+        flops_per_token = 3 * (L * (24*C*C + 4*T*C) + 2*C*V)
         flops_per_fwdbwd = flops_per_token * T
         flops_per_iter = flops_per_fwdbwd * fwdbwd_per_iter
         return flops_per_iter * (1.0/dt) # per second
 
+    def make_kv_cache(self, max_len=None):
+        """ Create an empty KV cache for this model, sized for at most max_len positions (default block_size). """
+        return KVCache(self.config.n_layer, max_len or self.config.block_size)
+
+    def make_slot_kv_cache(self, num_slots):
+        """ Create an empty KV cache of num_slots sequences of up to block_size positions each, for continuous batching. """
+        return SlotKVCache(self.config.n_layer, num_slots, self.config.block_size)
+
+    @staticmethod
+    def logits_to_probs(logits, temperature=1.0, top_k=None):
+        """ The sampling distribution over the last dim of logits (..., vocab_size) for temperature and top_k. """
+        # scale by desired temperature
+        logits = logits.float() / temperature
+        # optionally crop the logits to only the top k options
+        if top_k is not None:
+            v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
+            logits[logits < v[..., [-1]]] = -float('Inf')
+        # apply softmax to convert logits to (normalized) probabilities
+        return F.softmax(logits, dim=-1)
+
+    @staticmethod
+    def sample_logits(logits, temperature=1.0, top_k=None):
+        """ Sample one token per row from logits of shape (b, vocab_size) with temperature and top_k. """
+        return torch.multinomial(GPT.logits_to_probs(logits, temperature, top_k), num_samples=1)
+
     @torch.no_grad()
-    def generate(self, idx, max_new_tokens, temperature=1.0, top_k=None):
+    def generate(self, idx, max_new_tokens, temperature=1.0, top_k=None, use_cache=True, prefix_cache=None, window_stride=0):
         """
         Take a conditioning sequence of indices idx (LongTensor of shape (b,t)) and complete
         the sequence max_new_tokens times, feeding the predictions back into the model each time.
         Most likely you'll want to make sure to be in model.eval() mode of operation for this.
+        With use_cache, the prompt is forwarded once to fill a KV cache and every later step only
+        forwards the newest token. Once the sequence outgrows block_size see next_logits for how
+        window_stride trades context for speed.
+        A PrefixCache given as prefix_cache supplies the keys/values of the longest cached prefix
+        of the prompt, so only the rest is forwarded, and keeps the prompt's for later calls. It is
+        only used when every row of idx holds the same prompt.
         """
+        kv_cache = self.make_kv_cache() if use_cache else None
+        window_start = 0
+        prompt = None
+        if prefix_cache is not None and use_cache and idx.size(1) <= self.config.block_size and bool((idx == idx[:1]).all()):
+            prompt = idx[0].tolist()
+            # leave at least the last prompt token to forward, its logits give the first new token
+            n, kv = prefix_cache.lookup(prompt, len(prompt) - 1)
+            if n > 0:
+                kv_cache.load_prefix(kv, idx.size(0))
         for _ in range(max_new_tokens):
-            # if the sequence context is growing too long we must crop it at block_size
-            idx_cond = idx if idx.size(1) <= self.config.block_size else idx[:, -self.config.block_size:]
-            # forward the model to get the logits for the index in the sequence
-            logits, _ = self(idx_cond)
-            # pluck the logits at the final step and scale by desired temperature
-            logits = logits[:, -1, :] / temperature
-            # optionally crop the logits to only the top k options
-            if top_k is not None:
-                v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
-                logits[logits < v[:, [-1]]] = -float('Inf')
-            # apply softmax to convert logits to (normalized) probabilities
-            probs = F.softmax(logits, dim=-1)
-            # sample from the distribution
-            idx_next = torch.multinomial(probs, num_samples=1)
+            logits, window_start = self.next_logits(idx, kv_cache, window_start, window_stride)
+            if prompt is not None:
+                prefix_cache.insert(prompt, kv_cache.read_prefix(len(prompt)))
+                prompt = None
+            # pluck the logits at the final step and sample the next index
+            idx_next = self.sample_logits(logits[:, -1, :], temperature, top_k)
             # append sampled index to the running sequence and continue
             idx = torch.cat((idx, idx_next), dim=1)
 
         return idx
+
+    def next_logits(self, idx, kv_cache=None, window_start=0, window_stride=0):
+        """
+        One step of generate: the logits (b, 1, vocab_size) that predict the token after idx, and
+        the new window_start. kv_cache (if any) holds the keys/values of the window
+        idx[:, window_start:window_start+kv_cache.seq_len] and only the rest of idx is forwarded.
+        Past block_size tokens the learned absolute positions rule out shifting the cached window,
+        so with window_stride=0 every step forwards the full last block_size tokens (exact, but
+        block_size times the cost of a decode step). With window_stride=s > 0, a full window is
+        instead restarted on its last block_size-s tokens, which are re-prefilled in one forward,
+        and the next s tokens are cheap decode steps again: the context then varies between
+        block_size-s and block_size tokens, larger strides are faster and see less context.
+        """
+        block_size = self.config.block_size
+        if kv_cache is not None and idx.size(1) - window_start <= block_size:
+            # prefill with the (rest of the) window on the first step, afterwards just the newest token
+            logits, _ = self(idx[:, window_start + kv_cache.seq_len:], kv_cache=kv_cache)
+        elif kv_cache is not None and window_stride > 0:
+            assert window_stride < block_size, f"window_stride must be smaller than block_size={block_size}"
+            # the window is full, restart it on the most recent block_size - window_stride tokens
+            window_start = idx.size(1) - (block_size - window_stride)
+            kv_cache.crop(0)
+            logits, _ = self(idx[:, window_start:], kv_cache=kv_cache)
+        else:
+            # if the sequence context is growing too long we must crop it at block_size
+            idx_cond = idx if idx.size(1) <= block_size else idx[:, -block_size:]
+            # forward the model to get the logits for the index in the sequence
+            logits, _ = self(idx_cond)
+        return logits, window_start
+
+    @torch.no_grad()
+    def generate_speculative(self, idx, max_new_tokens, draft, k=4, temperature=1.0, top_k=None):
+        """
+        Like generate for a single sequence (idx of shape (1, t)), with speculative decoding: the
+        small draft GPT (same vocabulary) proposes k tokens one at a time, and this model scores all
+        of them in one forward pass. Draft token d with draft probability q(d) is accepted with
+        probability min(1, p(d)/q(d)) under this model's probability p, and the first rejected one
+        is replaced by a sample from max(0, p - q), renormalized. Every token is then distributed
+        exactly as with generate at the same temperature and top_k, while a target forward yields
+        up to k+1 tokens. Both models keep a KV cache that is cropped back to the accepted tokens.
+        Returns idx and a dict of counters (drafted, accepted, target forwards including those of
+        the plain decoding that continues past block_size).
+        """
+        assert idx.size(0) == 1, "speculative decoding supports a single sequence"
+        block_size = min(self.config.block_size, draft.config.block_size)
+        stats = {'drafted': 0, 'accepted': 0, 'forwards': 0}
+        cache, draft_cache = self.make_kv_cache(block_size), draft.make_kv_cache(block_size)
+        end = idx.size(1) + max_new_tokens
+        while idx.size(1) < end:
+            n = idx.size(1)
+            if n >= block_size:
+                break
+            # never draft past the end or past what the caches can hold
+            num_draft = min(k, end - n - 1, block_size - n)
+            # draft: feed what the draft cache hasn't seen yet, then sample num_draft tokens
+            drafted, draft_probs = [idx.new_empty(1, 0)], [torch.empty(0, self.config.vocab_size, device=idx.device)]
+            tokens = idx[:, draft_cache.seq_len:]
+            for _ in range(num_draft):
+                logits, _ = draft(tokens, kv_cache=draft_cache)
+                q = self.logits_to_probs(logits[:, -1, :], temperature, top_k)
+                tokens = torch.multinomial(q, num_samples=1)
+                drafted.append(tokens)
+                draft_probs.append(q)
+            drafted = torch.cat(drafted, dim=1) # (1, num_draft)
+            draft_probs = torch.cat(draft_probs) # (num_draft, vocab_size)
+            # verify: one forward over the unseen tokens plus the drafts, the logits of the last
+            # num_draft+1 positions predict every drafted token and one more
+            logits, _ = self(torch.cat((idx[:, cache.seq_len:], drafted), dim=1), kv_cache=cache, num_logits=num_draft+1)
+            p = self.logits_to_probs(logits[0], temperature, top_k) # (num_draft+1, vocab_size)
+            stats['forwards'] += 1
+            stats['drafted'] += num_draft
+            d = drafted[0]
+            rows = torch.arange(num_draft, device=idx.device)
+            accept = torch.rand(num_draft, device=idx.device) * draft_probs[rows, d] <= p[rows, d]
+            num_accepted = num_draft if bool(accept.all()) else int(accept.int().argmin())
+            if num_accepted < num_draft:
+                # resample the rejected position from the part of p that q under-proposes
+                residual = (p[num_accepted] - draft_probs[num_accepted]).clamp(min=0)
+                residual = residual if residual.sum() > 0 else p[num_accepted]
+                next_token = torch.multinomial(residual / residual.sum(), num_samples=1)
+            else:
+                # every draft was accepted, the last position gives one more token for free
+                next_token = torch.multinomial(p[num_draft], num_samples=1)
+            stats['accepted'] += num_accepted
+            idx = torch.cat((idx, d[:num_accepted].view(1, -1), next_token.view(1, 1)), dim=1)
+            # the caches may only hold tokens that were kept, all but the newest one
+            cache.crop(idx.size(1) - 1)
+            draft_cache.crop(idx.size(1) - 1)
+        if idx.size(1) < end:
+            # beyond the block size the window shifts every step, decode the rest the normal way,
+            # which takes one forward per token
+            stats['forwards'] += end - idx.size(1)
+            idx = self.generate(idx, end - idx.size(1), temperature=temperature, top_k=top_k)
+        return idx, stats
@@ -4,17 +4,21 @@ Variation of nanoGPT's 'sample.py' that allows for a prompt to be specified.
 import os
 import pickle
 from contextlib import nullcontext
+import time
 import torch
 import tiktoken
-from model import GPTConfig, GPT
+from model import GPTConfig, GPT, PrefixCache
+from checkpoint import load_model, clean_state_dict
+from quantize import quantize_model
 from tokenizers import Tokenizer
 
 # -----------------------------------------------------------------------------
-init_from = 'resume' # either 'resume' (from an out_dir) or a gpt2 variant (e.g. 'gpt2-xl')
-meta_pkl_path = './data/prepare-out/meta.pkl'
-out_dir = 'bpe-simplewiki-out' # ignored if init_from is not 'resume'
+init_from = 'resume' # 'resume' (ckpt.pt in out_dir), 'export' (model.pt from export.py in out_dir) or a gpt2 variant (e.g. 'gpt2-xl')
+meta_pkl_path = './data/prepare-out/meta.pkl' # not needed for 'export', the artifact knows its tokenizer
+out_dir = 'bpe-simplewiki-out' # ignored if init_from is a gpt2 variant
 start = input("Enter a prompt: ") # or "" or etc. Can also specify a file, use as: "FILE:prompt.txt"
 num_samples = 4 # number of samples to draw
+batch_samples = True # draw all samples in one batched generate call instead of one call per sample
 max_new_tokens = 500 # number of tokens generated in each sample
 temperature = 0.8 # 1.0 = no change, < 1.0 = less random, > 1.0 = more random, in predictions
 top_k = 200 # retain only the top_k most likely tokens, clamp others to have 0 probability
@@ -22,6 +26,12 @@ seed = 69
 device = 'cuda' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
 dtype = 'bfloat16' # 'float32' or 'bfloat16' or 'float16'
 compile = False # use PyTorch 2.0 to compile the model to be faster
+quantize = 'none' # cpu only: 'int8' (dynamic), 'int8_weight' (weight-only) or 'bf16' Linear layers, see quantize.py and bench_quantize.py
+threads = 0 # torch intra-op threads on the cpu, 0 for the torch default
+draft_model = '' # model.pt (see export.py) of a smaller GPT with the same tokenizer, enables speculative decoding
+speculate_k = 4 # tokens the draft model proposes per forward of the main model
+window_stride = 0 # past block_size re-prefill the window every this many tokens instead of recomputing it for every token, see GPT.next_logits
+prefix_cache_mb = 0 # memory for cached prompt keys/values, with batch_samples=False later samples skip the prompt forward, 0 to disable
 exec(open('configurator.py').read()) # overrides from command line or config file
 # -----------------------------------------------------------------------------
 
@@ -34,47 +44,100 @@ ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torc
 ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
 
 # model
-if init_from == 'resume':
+t0 = time.time()
+tokenizer_path = None
+if init_from == 'export':
+    # inference artifact written by export.py: memory-mapped, no optimizer state, no random init
+    model, artifact = load_model(os.path.join(out_dir, 'model.pt'), device)
+    tokenizer_path = artifact['tokenizer']
+elif init_from == 'resume':
     # init from a model saved in a specific directory
     ckpt_path = os.path.join(out_dir, 'ckpt.pt')
     checkpoint = torch.load(ckpt_path, map_location=device)
     gptconf = GPTConfig(**checkpoint['model_args'])
     model = GPT(gptconf)
-    state_dict = checkpoint['model']
-    unwanted_prefix = '_orig_mod.'
-    for k,v in list(state_dict.items()):
-        if k.startswith(unwanted_prefix):
-            state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
-    model.load_state_dict(state_dict)
+    model.load_state_dict(clean_state_dict(checkpoint['model']))
 elif init_from.startswith('gpt2'):
     # init from a given GPT-2 model
     model = GPT.from_pretrained(init_from, dict(dropout=0.0))
 
 model.eval()
 model.to(device)
+print(f"loaded model in {time.time()-t0:.2f}s")
+if threads > 0:
+    torch.set_num_threads(threads)
+if quantize != 'none':
+    # on the cpu ctx is a nullcontext, this is how to run at lower precision there
+    assert device_type == 'cpu', "quantize is for cpu inference"
+    model = quantize_model(model, quantize)
+    print(f"quantized the Linear layers to {quantize}, running on {torch.get_num_threads()} threads")
 if compile:
     model = torch.compile(model) # requires PyTorch 2.0 (optional)
+draft = None
+if draft_model:
+    draft, _ = load_model(draft_model, device)
+    assert draft.config.vocab_size == model.config.vocab_size, "the draft model must share the tokenizer"
+    if quantize != 'none':
+        draft = quantize_model(draft, quantize)
 
-print(f"Loading meta from {meta_pkl_path}...")
-with open(meta_pkl_path, 'rb') as f:
-    meta = pickle.load(f)
-tokenizer = Tokenizer.from_file(os.path.join('./data', meta['tokenizer']))
+if tokenizer_path is None:
+    print(f"Loading meta from {meta_pkl_path}...")
+    with open(meta_pkl_path, 'rb') as f:
+        meta = pickle.load(f)
+    tokenizer_path = os.path.join('./data', meta['tokenizer'])
+tokenizer = Tokenizer.from_file(tokenizer_path)
 
 # encode the beginning of the prompt
 start_ids = tokenizer.encode(start).ids
 x = (torch.tensor(start_ids, dtype=torch.long, device=device)[None, ...])
 
+def decode(ids):
+    decoded_and_joined = (''.join(tokenizer.decode(ids))).replace(' ', '')
+    return decoded_and_joined.replace('▁', ' ')
+
 # run generation
+gen_time = 0.0
+prefix_cache = PrefixCache(prefix_cache_mb * 2**20) if prefix_cache_mb > 0 else None
+spec_stats = {'drafted': 0, 'accepted': 0, 'forwards': 0}
+def draw_samples():
+    global gen_time
+    t0 = time.time()
+    if draft is not None:
+        # speculative decoding works on one sequence at a time
+        for _ in range(num_samples):
+            y, stats = model.generate_speculative(x, max_new_tokens, draft, speculate_k, temperature=temperature, top_k=top_k)
+            for key in spec_stats:
+                spec_stats[key] += stats[key]
+            gen_time += time.time() - t0
+            yield y[0].tolist()
+            t0 = time.time()
+    elif batch_samples:
+        # repeat the prompt along the batch dimension and draw every sample at once
+        y = model.generate(x.repeat(num_samples, 1), max_new_tokens, temperature=temperature, top_k=top_k, prefix_cache=prefix_cache, window_stride=window_stride)
+        gen_time += time.time() - t0
+        yield from (y[k].tolist() for k in range(num_samples))
+    else:
+        for _ in range(num_samples):
+            y = model.generate(x, max_new_tokens, temperature=temperature, top_k=top_k, prefix_cache=prefix_cache, window_stride=window_stride)
+            gen_time += time.time() - t0
+            yield y[0].tolist()
+            t0 = time.time()
+
 with torch.no_grad():
     with ctx:
         with open("sample.txt", 'w', encoding="utf-8", errors="ignore") as f_out:
             sample_text = ''
-            for k in range(num_samples):
-                y = model.generate(x, max_new_tokens, temperature=temperature, top_k=top_k)
-                model_out = y[0].tolist()
-                decoded_and_joined = (''.join(tokenizer.decode(model_out))).replace(' ', '')
-                remove_extra_spaces = decoded_and_joined.replace('▁', ' ')
+            for k, model_out in enumerate(draw_samples()):
+                remove_extra_spaces = decode(model_out)
                 sample_text += f'\n\n---- SAMPLE {k} -----\n' + remove_extra_spaces
                 print(remove_extra_spaces)
                 print('\n-------------------\n')
-            f_out.write(sample_text)
\ No newline at end of file
+            f_out.write(sample_text)
+
+print(f"generated {num_samples * max_new_tokens} tokens at {num_samples * max_new_tokens / gen_time:.1f} tokens/s")
+if draft is not None and spec_stats['drafted'] > 0:
+    print(f"speculative decoding: {spec_stats['accepted'] / spec_stats['drafted'] * 100:.1f}% of drafted tokens accepted, "
+          f"{num_samples * max_new_tokens / spec_stats['forwards']:.2f} tokens per forward of the main model")
+if prefix_cache is not None:
+    stats = prefix_cache.stats()
+    print(f"prefix cache: {stats['hit_rate'] * 100:.0f}% of prompts hit, {stats['saved_prefill_tokens']} prompt tokens not recomputed")
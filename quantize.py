@@ -0,0 +1,67 @@
+"""
+Low-precision cpu inference for a trained GPT: the nn.Linear layers of the attention, the MLP and
+the lm_head are converted in place of the fp32 ones, the embeddings and layernorms stay as they are.
+- 'int8': dynamic quantization, int8 weights (per output channel) and activations quantized per
+  row on the fly, int8 matmuls with int32 accumulation (fbgemm/onednn kernels on x86)
+- 'int8_weight': weight-only int8 (per output channel), the matmul runs in bfloat16 on the
+  dequantized weights
+- 'bf16': the Linear weights and activations in bfloat16
+Fewer bytes of weights to stream per token is what makes cpu decoding faster, see bench_quantize.py
+for tokens/s and the perplexity drift against fp32 on the val split.
+"""
+import warnings
+
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+
+QUANTIZE_MODES = ('none', 'int8', 'int8_weight', 'bf16')
+
+class Int8WeightLinear(nn.Module):
+    """ nn.Linear with int8 weights and a bfloat16 scale per output channel. """
+
+    def __init__(self, linear):
+        super().__init__()
+        weight = linear.weight.detach().float()
+        scale = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+        self.register_buffer('weight', (weight / scale[:, None]).round().to(torch.int8))
+        self.register_buffer('scale', scale.to(torch.bfloat16))
+        self.register_buffer('bias', None if linear.bias is None else linear.bias.detach().to(torch.bfloat16))
+
+    def forward(self, x):
+        y = torch._weight_int8pack_mm(x.reshape(-1, x.size(-1)).to(torch.bfloat16), self.weight, self.scale)
+        if self.bias is not None:
+            y = y + self.bias
+        return y.view(*x.shape[:-1], -1).to(x.dtype)
+
+class BF16Linear(nn.Module):
+    """ nn.Linear with bfloat16 weights, computing in bfloat16. """
+
+    def __init__(self, linear):
+        super().__init__()
+        self.register_buffer('weight', linear.weight.detach().to(torch.bfloat16))
+        self.register_buffer('bias', None if linear.bias is None else linear.bias.detach().to(torch.bfloat16))
+
+    def forward(self, x):
+        return F.linear(x.to(torch.bfloat16), self.weight, self.bias).to(x.dtype)
+
+def quantize_model(model, mode):
+    """
+    Convert the Linear layers of a GPT in eval mode for inference on the cpu, returns the model
+    (a copy for 'int8'). It is cast to float32 first (export.py writes bfloat16 weights by
+    default), which is all 'none' does. The lm_head gets its own copy of the weight it shares
+    with wte, so the tie is broken: the result is for inference only.
+    """
+    assert mode in QUANTIZE_MODES, f"unknown quantize mode {mode}, expected one of {QUANTIZE_MODES}"
+    model = model.float()
+    if mode == 'int8':
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore') # eager mode quantization is deprecated in favor of torchao
+            return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    if mode in ('int8_weight', 'bf16'):
+        wrapper = Int8WeightLinear if mode == 'int8_weight' else BF16Linear
+        for module in list(model.modules()):
+            for name, child in module.named_children():
+                if isinstance(child, nn.Linear):
+                    setattr(module, name, wrapper(child))
+    return model
@@ -0,0 +1,320 @@
+"""
+Local HTTP inference server. Loads a GPT and its tokenizer once and serves concurrent generation
+requests with continuous batching: a scheduler thread keeps one batch of running sequences in a
+SlotKVCache, new requests are prefilled and join it between decode steps, finished ones leave it
+right away, so short requests don't wait for long ones and the batch stays full under load.
+
+$ python serve.py --out_dir=bpe-simplewiki-out --device=cpu
+$ curl -N localhost:8000/generate -d '{"prompt": "the city", "max_new_tokens": 50, "stream": true}'
+$ curl localhost:8000/metrics
+
+POST /generate takes a JSON body with prompt and optionally max_new_tokens, temperature, top_k and
+stream. With stream, tokens come back as they are sampled as newline-delimited JSON objects
+({"token": id, "text": piece}) followed by a summary object with "done": true, otherwise the
+summary alone (with the full "text"). GET /metrics returns request counts, queue depths,
+throughput, latency percentiles (time to first token, time per output token, end to end) and
+the hit rate and saved prefill tokens of the prompt prefix cache.
+See loadtest.py for a synthetic load client.
+"""
+import os
+import json
+import time
+import queue
+import pickle
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import torch
+from model import GPTConfig, GPT, PrefixCache
+from checkpoint import load_model, clean_state_dict
+from tokenizers import Tokenizer
+
+# -----------------------------------------------------------------------------
+init_from = 'export' # 'export' (model.pt from export.py in out_dir) or 'resume' (ckpt.pt in out_dir)
+meta_pkl_path = './data/prepare-out/meta.pkl' # not needed for 'export', the artifact knows its tokenizer
+out_dir = 'bpe-simplewiki-out'
+host = '127.0.0.1'
+port = 8000
+max_batch_size = 8 # sequences decoded together, further requests wait in the queue
+prefix_cache_mb = 256 # memory for the keys/values of recent prompt prefixes, shared by requests with a common preamble, 0 to disable
+max_new_tokens = 200 # defaults of requests that don't set their own
+temperature = 0.8
+top_k = 200
+seed = 1337
+device = 'cpu' # examples: 'cpu', 'cuda', 'cuda:0', etc.
+dtype = 'float32' # 'float32' or 'bfloat16' or 'float16'
+threads = 0 # torch intra-op threads, 0 for the torch default
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+class Request:
+
+    def __init__(self, prompt_ids, max_new_tokens, temperature, top_k):
+        self.prompt_ids = prompt_ids
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_k = top_k
+        self.tokens = [] # generated so far
+        self.events = queue.Queue() # sampled token ids for the http thread, None once finished
+        self.error = None
+        self.cancelled = False # set when the client goes away, the scheduler then drops the sequence
+        self.arrival = time.perf_counter()
+        self.first_token = None
+        self.finish = None
+
+class ServerMetrics:
+    """ Counters and latency samples of the last `window` finished requests, read by GET /metrics. """
+
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.finished = deque(maxlen=window) # (finish time, ttft, tpot, e2e, new tokens) per request
+        self.counters = {'requests': 0, 'finished': 0, 'failed': 0, 'prompt_tokens': 0, 'generated_tokens': 0,
+                         'decode_steps': 0, 'decode_rows': 0, 'prefills': 0, 'prefill_tokens': 0}
+        self.gauges = {'running': 0, 'waiting': 0}
+
+    def add(self, **counts):
+        with self.lock:
+            for key, value in counts.items():
+                self.counters[key] += value
+
+    def set(self, **gauges):
+        with self.lock:
+            self.gauges.update(gauges)
+
+    def request_done(self, req):
+        e2e = req.finish - req.arrival
+        ttft = req.first_token - req.arrival
+        tpot = (req.finish - req.first_token) / (len(req.tokens) - 1) if len(req.tokens) > 1 else None
+        with self.lock:
+            self.counters['finished'] += 1
+            self.finished.append((req.finish, ttft, tpot, e2e, len(req.tokens)))
+
+    def snapshot(self, recent=10.0):
+        """ Everything as a dict, throughput over the requests that finished in the last `recent` seconds. """
+        now = time.perf_counter()
+        with self.lock:
+            out = {'uptime_s': now - self.start, **self.counters, **self.gauges}
+            finished = list(self.finished)
+        out['mean_batch_size'] = out['decode_rows'] / max(out['decode_steps'], 1)
+        out['tokens_per_s'] = out['generated_tokens'] / out['uptime_s']
+        out['recent_tokens_per_s'] = sum(f[4] for f in finished if now - f[0] <= recent) / recent
+        for i, name in ((1, 'ttft'), (2, 'tpot'), (3, 'e2e')):
+            values = sorted(f[i] for f in finished if f[i] is not None)
+            for p in (50, 90, 99):
+                out[f"{name}_p{p}_ms"] = values[min(len(values) * p // 100, len(values) - 1)] * 1000 if values else None
+        return out
+
+class Scheduler:
+    """
+    Continuous batching over a fixed number of KV cache slots. Every iteration admits waiting
+    requests into free slots (prefilling their prompts one at a time), then runs one decode step
+    over all running sequences and hands every sampled token to its request.
+    """
+
+    def __init__(self, model, max_batch_size, metrics, prefix_cache=None):
+        self.model = model
+        self.block_size = model.config.block_size
+        self.cache = model.make_slot_kv_cache(max_batch_size)
+        self.prefix_cache = prefix_cache
+        self.free_slots = list(range(max_batch_size))
+        self.running = {} # slot -> Request
+        self.waiting = queue.Queue()
+        self.metrics = metrics
+
+    def submit(self, req):
+        self.metrics.add(requests=1, prompt_tokens=len(req.prompt_ids))
+        self.waiting.put(req)
+
+    def run(self):
+        while True:
+            try:
+                self.admit()
+                if self.running:
+                    self.decode()
+            except Exception as e:
+                # anything admit and decode don't handle per request fails the running requests, not the thread
+                for slot in list(self.running):
+                    self.finish(slot, error=e)
+            self.metrics.set(running=len(self.running), waiting=self.waiting.qsize())
+
+    def admit(self):
+        while self.free_slots:
+            try:
+                # with nothing to decode, sleep until a request arrives
+                req = self.waiting.get(block=not self.running)
+            except queue.Empty:
+                return
+            slot = self.free_slots.pop()
+            self.running[slot] = req
+            try:
+                self.prefill(slot, req)
+            except Exception as e:
+                self.finish(slot, error=e)
+
+    @torch.no_grad()
+    def prefill(self, slot, req):
+        n = 0
+        if self.prefix_cache is not None:
+            # start from the longest cached prefix, the last prompt token is always forwarded for its logits
+            n, kv = self.prefix_cache.lookup(req.prompt_ids, len(req.prompt_ids) - 1)
+            if n > 0:
+                self.cache.load_prefix(kv, slot)
+        idx = torch.tensor([req.prompt_ids[n:]], dtype=torch.long, device=device)
+        with ctx:
+            logits, _ = self.model(idx, kv_cache=self.cache.select([slot]))
+        if self.prefix_cache is not None:
+            self.prefix_cache.insert(req.prompt_ids, self.cache.read_prefix(len(req.prompt_ids), slot))
+        self.metrics.add(prefills=1, prefill_tokens=idx.size(1))
+        self.emit(slot, GPT.sample_logits(logits[:, -1, :], req.temperature, req.top_k).item())
+
+    @torch.no_grad()
+    def decode(self):
+        slots = list(self.running)
+        idx = torch.tensor([[self.running[slot].tokens[-1]] for slot in slots], dtype=torch.long, device=device)
+        try:
+            with ctx:
+                logits, _ = self.model(idx, kv_cache=self.cache.select(slots))
+        except Exception as e:
+            for slot in slots:
+                self.finish(slot, error=e)
+            return
+        self.metrics.add(decode_steps=1, decode_rows=len(slots))
+        for i, slot in enumerate(slots):
+            req = self.running[slot]
+            try:
+                token = GPT.sample_logits(logits[i:i+1, -1, :], req.temperature, req.top_k).item()
+            except Exception as e:
+                # e.g. a top_k the request got wrong, only this sequence fails
+                self.finish(slot, error=e)
+                continue
+            self.emit(slot, token)
+
+    def emit(self, slot, token):
+        req = self.running[slot]
+        if req.first_token is None:
+            req.first_token = time.perf_counter()
+        req.tokens.append(token)
+        req.events.put(token)
+        self.metrics.add(generated_tokens=1)
+        # the newest token is only fed on the next step, so a full slot ends the sequence
+        if req.cancelled or len(req.tokens) >= req.max_new_tokens or self.cache.lengths[slot] >= self.block_size:
+            self.finish(slot)
+
+    def finish(self, slot, error=None):
+        req = self.running.pop(slot)
+        req.finish = time.perf_counter()
+        self.cache.free(slot)
+        self.free_slots.append(slot)
+        if error is None:
+            self.metrics.request_done(req)
+        else:
+            req.error = f"{type(error).__name__}: {error}"
+            self.metrics.add(failed=1)
+        req.events.put(None)
+
+class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            return self.send_json(404, {'error': f"unknown path {self.path}"})
+        out = metrics.snapshot()
+        if scheduler.prefix_cache is not None:
+            out.update({f"prefix_cache/{k}": v for k, v in scheduler.prefix_cache.stats().items()})
+        self.send_json(200, out)
+
+    def do_POST(self):
+        if self.path != '/generate':
+            return self.send_json(404, {'error': f"unknown path {self.path}"})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            prompt_ids = tokenizer.encode(body['prompt']).ids[-block_size:]
+            req = Request(prompt_ids or [0], int(body.get('max_new_tokens', max_new_tokens)),
+                          float(body.get('temperature', temperature)), body.get('top_k', top_k))
+            assert req.max_new_tokens > 0 and req.temperature > 0, "max_new_tokens and temperature must be positive"
+        except (ValueError, KeyError, TypeError, AssertionError) as e:
+            return self.send_json(400, {'error': f"bad request: {e!r}"})
+        scheduler.submit(req)
+
+        stream = bool(body.get('stream', False))
+        if stream:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.end_headers()
+        while (token := req.events.get()) is not None:
+            if stream:
+                try:
+                    self.write_line({'token': token, 'text': decode([token])})
+                except (BrokenPipeError, ConnectionResetError):
+                    req.cancelled = True
+                    return
+        summary = {
+            'done': True,
+            'prompt_tokens': len(req.prompt_ids),
+            'generated_tokens': len(req.tokens),
+            'ttft_ms': (req.first_token - req.arrival) * 1000 if req.first_token else None,
+            'latency_ms': (req.finish - req.arrival) * 1000,
+        }
+        if req.error is not None:
+            summary['error'] = req.error
+        if stream:
+            self.write_line(summary)
+        else:
+            self.send_json(200 if req.error is None else 500, {'text': decode(req.tokens), 'tokens': req.tokens, **summary})
+
+    def write_line(self, obj):
+        self.wfile.write((json.dumps(obj) + '\n').encode('utf-8'))
+        self.wfile.flush()
+
+    def send_json(self, status, obj):
+        data = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass # one line per request drowns the console under load, GET /metrics has the numbers
+
+if __name__ == "__main__":
+    torch.manual_seed(seed)
+    if threads > 0:
+        torch.set_num_threads(threads)
+    device_type = 'cuda' if 'cuda' in device else 'cpu'
+    ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
+    ctx = torch.amp.autocast(device_type=device_type, dtype=ptdtype, enabled=dtype != 'float32')
+
+    # model
+    tokenizer_path = None
+    if init_from == 'export':
+        model, artifact = load_model(os.path.join(out_dir, 'model.pt'), device)
+        tokenizer_path = artifact['tokenizer']
+    elif init_from == 'resume':
+        checkpoint = torch.load(os.path.join(out_dir, 'ckpt.pt'), map_location=device)
+        model = GPT(GPTConfig(**checkpoint['model_args']))
+        model.load_state_dict(clean_state_dict(checkpoint['model']))
+        model.eval()
+        model.to(device)
+    block_size = model.config.block_size
+    if tokenizer_path is None:
+        with open(meta_pkl_path, 'rb') as f:
+            meta = pickle.load(f)
+        tokenizer_path = os.path.join('./data', meta['tokenizer'])
+    tokenizer = Tokenizer.from_file(tokenizer_path)
+
+    def decode(ids):
+        decoded_and_joined = (''.join(tokenizer.decode(ids))).replace(' ', '')
+        return decoded_and_joined.replace('▁', ' ')
+
+    metrics = ServerMetrics()
+    prefix_cache = PrefixCache(prefix_cache_mb * 2**20) if prefix_cache_mb > 0 else None
+    scheduler = Scheduler(model, max_batch_size, metrics, prefix_cache)
+    threading.Thread(target=scheduler.run, daemon=True).start()
+    server = ThreadingHTTPServer((host, port), Handler)
+    print(f"serving on http://{host}:{port} with up to {max_batch_size} sequences per batch")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -17,19 +17,20 @@ $ torchrun --nproc_per_node=8 --nnodes=2 --node_rank=1 --master_addr=123.456.123
 """
 
 import os
-import random
 import time
 import math
 import pickle
 import gc
 from contextlib import nullcontext
 
-import numpy as np
 import torch
 from torch.nn.parallel import DistributedDataParallel as DDP
-from torch.distributed import init_process_group, destroy_process_group
+from torch.distributed import init_process_group, destroy_process_group, all_reduce
 
 from model import GPTConfig, GPT
+from checkpoint import CheckpointWriter
+from metrics import PhaseTimer, ProfilerWindows, MetricsLogger, JSONLSink, CSVSink, WandbSink, peak_memory, lookup_peak_flops, measure_peak_flops
+from dataloader import ShardedDataset, EpochSampler, BatchPrefetcher, load_manifest, split_xy
 
 # -----------------------------------------------------------------------------
 # default config values designed to train a gpt2 (124M) on OpenWebText
@@ -37,10 +38,20 @@ from model import GPTConfig, GPT
 out_dir = 'train-simplewiki-out'
 eval_interval = 1000 # iters per eval
 log_interval = 10
-eval_iters = 200
+eval_iters = 200 # batches per split and eval, split between the ddp ranks
+eval_fixed_val = False # evaluate val on the same eval_iters batches every time, read once and kept on the device
 eval_only = False # if True, script exits right after the first eval
 always_save_checkpoint = True # if True, always save a checkpoint after each eval
+async_checkpoint = True # snapshot checkpoints to host memory and write them on a background thread
+keep_last_checkpoints = 0 # also keep the last N checkpoints as ckpt-<iter>-<val loss>.pt, 0 to disable
+keep_best_checkpoints = 0 # also keep the best K checkpoints by val loss, 0 to disable
 init_from = 'resume' # 'scratch' or 'resume' or 'gpt2*'
+# metrics, written to out_dir/metrics.<jsonl|csv> and optionally wandb
+metrics_log = 'jsonl' # local metrics sink: 'jsonl', 'csv' or '' to disable
+sync_timing = False # synchronize cuda after each timed phase (data, forward, backward, ...) so the per-phase times are accurate, costs throughput
+profile_start = -1 # iteration to start a torch.profiler capture at, -1 to disable
+profile_iters = 5 # iterations per profiler capture
+profile_every = 0 # repeat the capture every this many iterations, 0 to capture once
 # wandb logging
 wandb_log = True # disabled by default
 wandb_project = 'nanogptebpe'
@@ -48,6 +59,8 @@ wandb_run_name = 'run' + str(time.time()) # 'run' + str(time.time())
 # data
 dataset = 'data/prepare-out'
 multi_file_dataset = True # set true if dataset is split into multiple files
+prefetch_depth = 4 # number of train batches prepared ahead on a background thread, 0 to load synchronously
+data_seed = 1337 # seed of the per-epoch order in which the training windows are read
 gradient_accumulation_steps = 4 # used to simulate larger batch sizes
 batch_size = 4 # if gradient_accumulation_steps > 1, this is the micro-batch size
 block_size = 512 # AKA context length
@@ -57,6 +70,8 @@ n_head = 16 # 12 for gpt2, 16 for gpt2-xl
 n_embd = 1024 # 768 for gpt2, 1024 for gpt2-xl
 dropout = 0.0 # for pretraining 0 is good, for finetuning try 0.1+
 bias = False # do we use bias inside LayerNorm and Linear layers?
+activation_checkpointing = 'none' # recompute these blocks in backward to save memory: 'none', 'all' or e.g. "0 2 4"
+loss_chunk_size = 0 # compute lm_head + loss over chunks of this many positions instead of the whole (B, T, vocab) logits, 0 to disable
 # adamw optimizer
 learning_rate = 6e-4 # max learning rate
 max_iters = 600000 # total number of training iterations
@@ -70,11 +85,12 @@ warmup_iters = 2000 # how many steps to warm up for
 lr_decay_iters = 600000 # should be ~= max_iters per Chinchilla
 min_lr = 6e-5 # minimum learning rate, should be ~= learning_rate/10 per Chinchilla
 # DDP settings
-backend = 'nccl' # 'nccl', 'gloo', etc.
+backend = 'nccl' # 'nccl', 'gloo', etc. (gloo runs ddp on the cpu with device='cpu')
 # system
 device = 'cuda' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1' etc., or try 'mps' on macbooks
 dtype = 'bfloat16' # 'float32', 'bfloat16', or 'float16', the latter will auto implement a GradScaler
 compile = False # use PyTorch 2.0 to compile the model to be faster
+flops_promised = 0.0 # peak flops of the device for mfu, 0 to look the gpu up in metrics.PEAK_FLOPS or else measure a matmul
 # -----------------------------------------------------------------------------
 config_keys = [k for k,v in globals().items() if not k.startswith('_') and isinstance(v, (int, float, bool, str))]
 exec(open('configurator.py').read()) # overrides from command line or config file
@@ -87,14 +103,17 @@ if ddp:
     init_process_group(backend=backend)
     ddp_rank = int(os.environ['RANK'])
     ddp_local_rank = int(os.environ['LOCAL_RANK'])
-    device = f'cuda:{ddp_local_rank}'
-    torch.cuda.set_device(device)
+    ddp_world_size = int(os.environ['WORLD_SIZE'])
+    if 'cuda' in device:
+        device = f'cuda:{ddp_local_rank}'
+        torch.cuda.set_device(device)
     master_process = ddp_rank == 0 # this process will do logging, checkpointing etc.
     seed_offset = ddp_rank # each process gets a different seed
 else:
     # if not ddp, we are running on a single gpu, and one process
     master_process = True
     seed_offset = 0
+    ddp_rank, ddp_world_size = 0, 1
     gradient_accumulation_steps *= 8 # simulate 8 gpus
 
 if master_process:
@@ -108,87 +127,64 @@ ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torc
 ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
 
 data_dir = dataset
-train_dir = os.path.join(data_dir, 'train')
-val_dir = os.path.join(data_dir, 'val')
-
-# DATA LOADER ------------------------------------
-def get_batch(split):
-    # Adrej Karpathy's original data loader for single val.bin and train.bin files
-    if(multi_file_dataset == False):
-        train_data = np.memmap(os.path.join(data_dir, 'train.bin'), dtype=np.uint16, mode='r')
-        val_data = np.memmap(os.path.join(data_dir, 'val.bin'), dtype=np.uint16, mode='r')
-        data = train_data if split == 'train' else val_data
-        ix = torch.randint(len(data) - block_size, (batch_size,))
-        x = torch.stack([torch.from_numpy((data[i:i+block_size]).astype(np.int64)) for i in ix])
-        y = torch.stack([torch.from_numpy((data[i+1:i+1+block_size]).astype(np.int64)) for i in ix])
-        if device_type == 'cuda':
-            # pin arrays x,y, which allows us to move them to GPU asynchronously (non_blocking=True)
-            x, y = x.pin_memory().to(device, non_blocking=True), y.pin_memory().to(device, non_blocking=True)
-        else:
-            x, y = x.to(device), y.to(device)
-        return x, y
-    
-    # my multi-file data loader, with bin files in train/ and val/ directories
-    else:
-        train_files = os.listdir(train_dir)
-        val_files = os.listdir(val_dir)
-        files = train_files if split == 'train' else val_files
-        dir = train_dir if split == 'train' else val_dir
-
-        # random file indices to sample from
-        rand_files = torch.randint(len(files) - 1, (batch_size,))
-        x_list, y_list = [], []
-
-        # not sure why, but sometimes an extracted block will be 1 less than block_size
-        # so I need to do this to make sure the block is the correct size
-        def get_xy_vals(data):
-            x_val = []
-            y_val = []
-            while len(x_val) != block_size or len(y_val) != block_size:
-                # get a random integer less than the length of the file
-                # and get a block of text of length block_size from that position
-                rand = random.randint(0, len(data) - block_size)
-                x_val = torch.from_numpy((data[rand:rand+block_size]).astype(np.int64))
-                y_val = torch.from_numpy((data[rand+1:rand+1+block_size]).astype(np.int64))
-            return x_val, y_val
-
-        # get a random snippet of text from a random file
-        for index in rand_files:
-            data = np.memmap(os.path.join(dir, files[index]), dtype=np.uint16, mode='r')
-            # get a random integer less than the length of the file
-            # and get a block of text of length block_size from that position
-            rand = random.randint(0, len(data) - block_size)
-            x_val, y_val = get_xy_vals(data)
-            x_list.append(x_val)
-            y_list.append(y_val)
-
-        x = torch.stack(x_list)
-        y = torch.stack(y_list)
-
-        if device_type == 'cuda':
-            x, y = x.pin_memory().to(device, non_blocking=True), y.pin_memory().to(device, non_blocking=True)
-        else:
-            x, y = x.to(device), y.to(device)
-
-        return x, y
-#-------------------------------------------------
-
-# init these up here, can override if init_from='resume' (i.e. from a checkpoint)
-iter_num = 0
-best_val_loss = 1e9
 
 # attempt to derive vocab_size from the dataset
 meta_path = os.path.join(data_dir, 'meta.pkl')
 meta_vocab_size = None
+token_dtype = 'uint16' # datasets without a recorded dtype were always written as uint16
 if os.path.exists(meta_path):
     with open(meta_path, 'rb') as f:
         meta = pickle.load(f)
     meta_vocab_size = meta['vocab_size']
-    print(f"found vocab_size = {meta_vocab_size} (inside {meta_path})")
+    token_dtype = meta.get('dtype', token_dtype)
+    print(f"found vocab_size = {meta_vocab_size}, token dtype = {token_dtype} (inside {meta_path})")
+
+# DATA LOADER ------------------------------------
+# Karpathy's original layout is a single train.bin / val.bin, the multi-file layout has bin
+# shards in train/ and val/ directories listed in manifest.pkl. Either way the memmaps are
+# opened once and windows are sampled weighted by how many tokens each shard holds.
+if multi_file_dataset:
+    manifest = load_manifest(data_dir, token_dtype)
+    datasets = {split: ShardedDataset(os.path.join(data_dir, split), manifest[split], block_size, token_dtype) for split in ['train', 'val']}
+else:
+    datasets = {split: ShardedDataset.from_single_file(os.path.join(data_dir, f'{split}.bin'), block_size, token_dtype) for split in ['train', 'val']}
+
+# training reads every non-overlapping window once per epoch, in a seeded order that is split
+# between the ddp ranks and resumed from the checkpoint, evaluation samples random windows
+sampler = EpochSampler(datasets['train'].num_chunks, batch_size, data_seed, ddp_rank, ddp_world_size)
+tokens_per_iter = gradient_accumulation_steps * ddp_world_size * batch_size * block_size
+print(f"tokens per iteration: {tokens_per_iter:,}, one epoch of {datasets['train'].num_chunks * block_size:,} "
+      f"train tokens is {datasets['train'].num_chunks * block_size / tokens_per_iter:,.1f} iterations")
+
+def to_device(tokens): # (B, block_size+1), x and y are views into it
+    if device_type == 'cuda':
+        # pin the array, which allows us to move it to GPU asynchronously (non_blocking=True)
+        tokens = tokens.pin_memory().to(device, non_blocking=True)
+    else:
+        tokens = tokens.to(device)
+    return split_xy(tokens)
+
+def get_batch(split):
+    return to_device(datasets[split].sample(batch_size))
+
+# optionally a fixed val set: evenly spread windows that are the same in every eval and every run,
+# each rank keeps only the batches it evaluates
+val_batches = None
+if eval_fixed_val:
+    val_chunks = datasets['val'].spread(eval_iters * batch_size)
+    val_batches = {k: to_device(datasets['val'].read(val_chunks[k*batch_size:(k+1)*batch_size]))
+                   for k in range(ddp_rank, eval_iters, ddp_world_size)}
+
+#-------------------------------------------------
+
+# init these up here, can override if init_from='resume' (i.e. from a checkpoint)
+iter_num = 0
+best_val_loss = 1e9
+data_windows = 0 # training windows handed out over all ranks, the position of the data order
 
 # model init
 model_args = dict(n_layer=n_layer, n_head=n_head, n_embd=n_embd, block_size=block_size,
-                  bias=bias, vocab_size=None, dropout=dropout) # start with model_args from command line
+                  bias=bias, vocab_size=None, dropout=dropout, activation_checkpointing=activation_checkpointing, loss_chunk_size=loss_chunk_size) # start with model_args from command line
 if init_from == 'scratch':
     # init a new model from scratch
     print(f"Initializing a new model from scratch. Bactch size: {batch_size}")
@@ -221,6 +217,7 @@ elif init_from == 'resume':
     model.load_state_dict(state_dict)
     iter_num = checkpoint['iter_num']
     best_val_loss = checkpoint['best_val_loss']
+    data_windows = checkpoint.get('data_windows', 0)
 elif init_from.startswith('gpt2'):
     print(f"Initializing from OpenAI GPT-2 weights: {init_from}")
     # initialize from OpenAI GPT-2 weights
@@ -250,25 +247,41 @@ if compile:
     unoptimized_model = model
     model = torch.compile(model) # requires PyTorch 2.0
 
+# train batches come from a background prefetcher that keeps a queue of ready batches,
+# they are produced in step order so train_step is the step of the next batch handed out
+train_step = sampler.step_at(data_windows)
+prefetcher = BatchPrefetcher(datasets['train'], batch_size, device, prefetch_depth, sampler=sampler, step=train_step) if prefetch_depth > 0 else None
+def get_train_batch():
+    global train_step
+    if prefetcher is not None:
+        batch = prefetcher.next()
+    else:
+        batch = to_device(datasets['train'].read(sampler.indices(train_step)))
+    train_step += 1
+    return batch
+
 # wrap model into DDP container
 if ddp:
-    model = DDP(model, device_ids=[ddp_local_rank])
+    model = DDP(model, device_ids=[ddp_local_rank] if device_type == 'cuda' else None)
 
 # helps estimate an arbitrarily accurate loss over either split using many batches
+# every rank evaluates its share of the eval_iters batches and the loss sums stay on the device
+# until a single all-reduce, so there is no host sync per batch
 @torch.no_grad()
 def estimate_loss():
-    out = {}
     model.eval()
-    for split in ['train', 'val']:
-        losses = torch.zeros(eval_iters)
-        for k in range(eval_iters):
-            X, Y = get_batch(split)
+    loss_sums = torch.zeros(2, device=device)
+    for i, split in enumerate(['train', 'val']):
+        for k in range(ddp_rank, eval_iters, ddp_world_size):
+            X, Y = val_batches[k] if split == 'val' and val_batches is not None else get_batch(split)
             with ctx:
-                logits, loss = model(X, Y)
-            losses[k] = loss.item()
-        out[split] = losses.mean()
+                logits, loss = model(X, Y, return_logits=False)
+            loss_sums[i] += loss.float()
+    if ddp:
+        all_reduce(loss_sums)
+    train_loss, val_loss = (loss_sums / eval_iters).tolist()
     model.train()
-    return out
+    return {'train': train_loss, 'val': val_loss}
 
 # learning rate decay scheduler (cosine with warmup)
 def get_lr(it):
@@ -285,18 +298,41 @@ def get_lr(it):
     return min_lr + coeff * (learning_rate - min_lr)
 
 # logging
-if wandb_log and master_process:
-    import wandb
-    wandb.init(project=wandb_project, name=wandb_run_name, config=config)
+if master_process:
+    sinks = []
+    if metrics_log:
+        sinks.append({'jsonl': JSONLSink, 'csv': CSVSink}[metrics_log](os.path.join(out_dir, f"metrics.{metrics_log}")))
+    if wandb_log:
+        sinks.append(WandbSink(wandb_project, wandb_run_name, config))
+    metrics_logger = MetricsLogger(sinks)
+timer = PhaseTimer(sync=sync_timing)
+profiler = ProfilerWindows(profile_start if master_process else -1, profile_iters, out_dir, device_type, every=profile_every)
+
+# the peak flops mfu is measured against, for the dtype the matmuls actually run in
+if master_process and flops_promised <= 0:
+    compute_dtype = dtype if device_type == 'cuda' else 'float32' # no autocast on the cpu
+    # float32 matmuls run on the tf32 tensor cores when allowed above, measure_peak_flops picks that up itself
+    peak_dtype = 'tfloat32' if device_type == 'cuda' and compute_dtype == 'float32' and torch.backends.cuda.matmul.allow_tf32 else compute_dtype
+    flops_promised = lookup_peak_flops(device, peak_dtype)
+    if flops_promised is None:
+        flops_promised = measure_peak_flops(device, compute_dtype)
+        print(f"measured {compute_dtype} matmul peak of {flops_promised/1e12:.2f} TFLOPS for mfu")
+    else:
+        print(f"using the {peak_dtype} peak of {flops_promised/1e12:.1f} TFLOPS of {torch.cuda.get_device_name(device)} for mfu")
+
+# checkpoints are written atomically, by default in the background while training goes on
+if master_process:
+    checkpoint_writer = CheckpointWriter(out_dir, keep_last_checkpoints, keep_best_checkpoints, background=async_checkpoint)
 
 # training loop
-X, Y = get_batch('train') # fetch the very first batch
+X, Y = get_train_batch() # fetch the very first batch
 t0 = time.time()
 local_iter_num = 0 # number of iterations in the lifetime of this process
 raw_model = model.module if ddp else model # unwrap DDP container if needed
 running_flops = -1.0
 running_mfu = -1.0
 while True:
+    profiler.begin(iter_num)
 
     # determine and set the learning rate for this iteration
     lr = get_lr(iter_num) if decay_lr else learning_rate
@@ -304,28 +340,33 @@ while True:
         param_group['lr'] = lr
 
     # evaluate the loss on train/val sets and write checkpoints
+    if iter_num % eval_interval == 0:
+        with timer('eval'):
+            losses = estimate_loss() # on all ranks
     if iter_num % eval_interval == 0 and master_process:
-        losses = estimate_loss()
         print(f"step {iter_num}: train loss {losses['train']:.4f}, val loss {losses['val']:.4f}")
-        if wandb_log:
-            wandb.log({
-                "val/loss": losses['val'],
-                "lr": lr,
-                "mfu": running_mfu*100, # convert to percentage
-            })
+        metrics_logger.log({
+            "train/loss": losses['train'],
+            "val/loss": losses['val'],
+            "lr": lr,
+            "mfu": running_mfu*100, # convert to percentage
+        }, iter_num)
         if losses['val'] < best_val_loss or always_save_checkpoint:
             best_val_loss = losses['val']
             if iter_num > 0:
-                checkpoint = {
-                    'model': raw_model.state_dict(),
-                    'optimizer': optimizer.state_dict(),
-                    'model_args': model_args,
-                    'iter_num': iter_num,
-                    'best_val_loss': best_val_loss,
-                    'config': config,
-                }
-                print(f"saving checkpoint to {out_dir}")
-                torch.save(checkpoint, os.path.join(out_dir, 'ckpt.pt'))
+                with timer('checkpoint'):
+                    checkpoint = {
+                        'model': raw_model.state_dict(),
+                        'optimizer': optimizer.state_dict(),
+                        'model_args': model_args,
+                        'iter_num': iter_num,
+                        'best_val_loss': best_val_loss,
+                        'data_windows': sampler.windows_seen(train_step - 1), # X, Y are not trained on yet
+                        'config': config,
+                    }
+                    print(f"saving checkpoint to {out_dir}")
+                    checkpoint_writer.save(checkpoint, iter_num, losses['val'])
+                    checkpoint = None
     if iter_num == 0 and eval_only:
         break
 
@@ -338,21 +379,28 @@ while True:
             # I really dislike that this bloats the code and forces us to repeat code
             # looking at the source of that context manager, it just toggles this variable
             model.require_backward_grad_sync = (micro_step == gradient_accumulation_steps - 1)
-        with ctx:
-            logits, loss = model(X, Y)
-        # immediately async prefetch next batch while model is doing the forward pass on the GPU
-        X, Y = get_batch('train')
+        with timer('forward'), ctx:
+            logits, loss = model(X, Y, return_logits=False)
+        # immediately fetch the next batch while model is doing the forward pass on the GPU,
+        # the prefetcher has normally prepared it already on its background thread
+        with timer('data'):
+            X, Y = get_train_batch()
         # backward pass, with gradient scaling if training in fp16
-        scaler.scale(loss).backward()
+        with timer('backward'):
+            scaler.scale(loss).backward()
     # clip the gradient
     if grad_clip != 0.0:
-        scaler.unscale_(optimizer)
-        torch.nn.utils.clip_grad_norm_(model.parameters(), grad_clip)
+        with timer('clip'):
+            scaler.unscale_(optimizer)
+            torch.nn.utils.clip_grad_norm_(model.parameters(), grad_clip)
     # step the optimizer and scaler if training in fp16
-    scaler.step(optimizer)
-    scaler.update()
-    # flush the gradients as soon as we can, no need for this memory anymore
-    optimizer.zero_grad(set_to_none=True)
+    with timer('optimizer'):
+        scaler.step(optimizer)
+        scaler.update()
+        # flush the gradients as soon as we can, no need for this memory anymore
+        optimizer.zero_grad(set_to_none=True)
+    timer.step()
+    profiler.end(iter_num)
 
     # timing and logging
     t1 = time.time()
@@ -361,20 +409,25 @@ while True:
     if iter_num % log_interval == 0 and master_process:
         lossf = loss.item() # loss as float. note: this is a CPU-GPU sync point
         if local_iter_num >= 5: # let the training loop settle a bit
-            flops_achieved = raw_model.estimate_flops(batch_size * gradient_accumulation_steps, dt)
-            flops_promised = 16.2e12 # RTX3060ti GPU bfloat16 peak flops is 312 TFLOPS
+            flops_achieved = raw_model.estimate_flops(batch_size * gradient_accumulation_steps, dt, seq_len=X.size(1))
             mfu = flops_achieved / flops_promised
             running_flops = flops_achieved if running_flops == -1.0 else 0.9*running_flops + 0.1*flops_achieved
             running_mfu = mfu if running_mfu == -1.0 else 0.9*running_mfu + 0.1*mfu
-        print(f"{iter_num}: {dt*1000:.2f}ms, {running_flops/1e12:.2f}Tflops | loss: {lossf:.4f}, mfu: {running_mfu*100:.2f}%")
-        if wandb_log:
-            wandb.log({
-                "iter": iter_num,
-                "iter_time_ms": dt*1000,
-                "loss": lossf,
-                "mfu": running_mfu*100,
-                "tflops": running_flops/1e12
-            })
+        data_stats = prefetcher.stats() if prefetcher is not None else {'queue_depth': 0.0, 'stall_time': 0.0}
+        phase_stats = timer.stats()
+        print(f"{iter_num}: {dt*1000:.2f}ms, {running_flops/1e12:.2f}Tflops | loss: {lossf:.4f}, mfu: {running_mfu*100:.2f}% | data stall: {data_stats['stall_time']*1000:.2f}ms/batch, queue: {data_stats['queue_depth']:.1f}")
+        print("    ms/iter: " + ", ".join(f"{phase} {ms:.1f}" for phase, ms in phase_stats.items()))
+        metrics_logger.log({
+            "iter_time_ms": dt*1000,
+            "loss": lossf,
+            "lr": lr,
+            "mfu": running_mfu*100,
+            "tflops": running_flops/1e12,
+            "data/stall_ms_per_batch": data_stats['stall_time']*1000,
+            "data/queue_depth": data_stats['queue_depth'],
+            **{f"time/{phase}_ms": ms for phase, ms in phase_stats.items()},
+            **peak_memory(device_type),
+        }, iter_num)
     iter_num += 1
     local_iter_num += 1
 
@@ -382,5 +435,10 @@ while True:
     if iter_num > max_iters:
         break
 
+if master_process:
+    checkpoint_writer.close() # wait for the last checkpoint to hit the disk
+    metrics_logger.close()
+if prefetcher is not None:
+    prefetcher.close()
 if ddp:
     destroy_process_group()